@@ -0,0 +1,55 @@
+# coding=utf-8
+#
+#  Copyright (c) 2014-2015 First Flamingo Enterprise B.V.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  bench_markup_dates.py
+#  firstflamingo/python_utilities
+#
+#  Formatting a 50k-cell timetable: date and time elements for repeating timestamps.
+#  Run with the App Engine SDK on the python path: python benchmarks/bench_markup_dates.py [cells]
+#
+
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import markup
+
+
+def best_of(repeat, function):
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main(cells=50000):
+    stamps = [datetime.datetime(2015, i % 12 + 1, i % 28 + 1, i % 24, i * 7 % 60) for i in range(500)]
+    timetable = (stamps * (cells // len(stamps) + 1))[:cells]
+
+    def format_cells():
+        for stamp in timetable:
+            markup.date(stamp)
+            markup.time(stamp)
+
+    print '%d date cells and %d time cells: %.3f s (best of 5)' % (cells, cells, best_of(5, format_cells))
+
+
+if __name__ == '__main__':
+    main(*[int(argument) for argument in sys.argv[1:]])
@@ -0,0 +1,56 @@
+# coding=utf-8
+#
+#  Copyright (c) 2014-2015 First Flamingo Enterprise B.V.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  bench_markup_table.py
+#  firstflamingo/python_utilities
+#
+#  Memory and throughput of building and writing a large HTMLTable.
+#  Run with the App Engine SDK on the python path: python benchmarks/bench_markup_table.py [rows] [columns]
+#  Run it in a separate process per measurement, peak memory is measured for the whole process.
+#
+
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import markup
+
+
+def peak_memory_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def main(rows=10000, columns=10):
+    base = peak_memory_mb()
+    start = time.time()
+    table = markup.HTMLTable('t', ['c%d' % i for i in range(columns)])
+    for row in range(rows):
+        table_row = table.add_row()
+        for column in range(columns):
+            table_row.add_to_cell(column, '%d' % (row * column))
+    build_time = time.time() - start
+    build_memory = peak_memory_mb() - base
+    start = time.time()
+    size = len(table.write(0))
+    write_time = time.time() - start
+    print '%d x %d table: build %.2f s, +%.0f MB peak, write %.2f s (%d characters)' % (
+        rows, columns, build_time, build_memory, write_time, size)
+
+
+if __name__ == '__main__':
+    main(*[int(argument) for argument in sys.argv[1:]])
@@ -0,0 +1,69 @@
+# coding=utf-8
+#
+#  Copyright (c) 2014-2015 First Flamingo Enterprise B.V.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  bench_negotiation.py
+#  firstflamingo/python_utilities
+#
+#  Content negotiation for repeated Accept headers, memoized by rest_negotiation against parsing every header.
+#  Run with the App Engine SDK on the python path: python benchmarks/bench_negotiation.py [requests]
+#
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import rest_negotiation
+from rest_resources import PublicResource
+
+ACCEPT_HEADERS = [
+    'application/json',
+    '*/*',
+    'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'application/msgpack, application/json;q=0.5',
+    'application/json, text/javascript, */*; q=0.01',
+]
+
+
+def best_of(repeat, function):
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main(requests=100000):
+    headers = (ACCEPT_HEADERS * (requests // len(ACCEPT_HEADERS) + 1))[:requests]
+    data_types = PublicResource.writable_data_types()
+
+    def parsed():
+        for header in headers:
+            rest_negotiation.best_data_type(rest_negotiation.parse_media_ranges(header), data_types)
+
+    def memoized():
+        for header in headers:
+            rest_negotiation.output_data_type(header, PublicResource)
+
+    parse_time = best_of(5, parsed)
+    memo_time = best_of(5, memoized)
+    print '%d requests: parsed %.3f s, memoized %.3f s, speedup %.1f (best of 5)' % (
+        requests, parse_time, memo_time, parse_time / memo_time)
+
+
+if __name__ == '__main__':
+    main(*[int(argument) for argument in sys.argv[1:]])
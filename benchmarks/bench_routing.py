@@ -0,0 +1,84 @@
+# coding=utf-8
+#
+#  Copyright (c) 2014-2015 First Flamingo Enterprise B.V.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  bench_routing.py
+#  firstflamingo/python_utilities
+#
+#  Routing requests to many resource classes through the url_name registry of ResourceHandler,
+#  against a route table that is matched linearly with one regular expression per class.
+#  Routing and identifier validation are timed separately.
+#  Run with the App Engine SDK on the python path: python benchmarks/bench_routing.py [classes] [requests]
+#
+
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from rest_interface import ResourceHandler
+from rest_resources import PublicResource
+
+
+class BenchmarkHandler(ResourceHandler):
+    pass
+
+
+def best_of(repeat, function):
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main(classes=100, requests=100000):
+    resource_classes = [type('Resource%03d' % i, (PublicResource,), {'url_name': 'area/resource%03d' % i})
+                        for i in range(classes)]
+    BenchmarkHandler.register(*resource_classes)
+    route_table = [(re.compile('^/api/%s(/.*)?$' % resource_class.url_name), resource_class)
+                   for resource_class in resource_classes]
+    paths = ['/api/area/resource%03d/item%d' % (i % classes, i % 1000) for i in range(requests)]
+    handler = BenchmarkHandler()
+
+    def registry():
+        for path in paths:
+            handler.route(path.split('/'))
+
+    def linear():
+        for path in paths:
+            for pattern, resource_class in route_table:
+                if pattern.match(path):
+                    break
+
+    handler.resource_class = resource_classes[0]
+    identifiers = [path.split('/')[4] for path in paths]
+
+    def validation():
+        for identifier in identifiers:
+            handler.validated_identifier(identifier)
+
+    linear_time = best_of(5, linear)
+    registry_time = best_of(5, registry)
+    validation_time = best_of(5, validation)
+    print '%d classes, %d requests (best of 5):' % (classes, requests)
+    print '  routing: linear route table %.3f s, registry %.3f s, speedup %.1f' % (
+        linear_time, registry_time, linear_time / registry_time)
+    print '  identifier validation: %.3f s' % validation_time
+
+if __name__ == '__main__':
+    main(*[int(argument) for argument in sys.argv[1:]])
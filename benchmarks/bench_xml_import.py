@@ -0,0 +1,110 @@
+# coding=utf-8
+#
+#  Copyright (c) 2014-2015 First Flamingo Enterprise B.V.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  bench_xml_import.py
+#  firstflamingo/python_utilities
+#
+#  Throughput of XMLImporter on a synthetic timetable feed, with the xml.sax engine and the expat engine.
+#  Run with the App Engine SDK on the python path: python benchmarks/bench_xml_import.py [trips]
+#
+
+import os
+import sys
+import time
+import xml.sax
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import markup
+
+
+class TripImporter(markup.XMLImporter):
+    """
+    Importer with hooks that do realistic work: reading attributes and text of nested elements
+    """
+
+    def active_xml_tags(self):
+        return 'trip'
+
+    def observed_xml_tags(self):
+        return 'stop', 'name'
+
+    def start_xml_element(self, name, attrs):
+        if name == 'trip':
+            self.key = attrs.get('id')
+            self.stops = []
+        elif name == 'stop':
+            self.stops.append(attrs.get('code'))
+
+    def end_xml_element(self, name):
+        if name == 'name':
+            self.name = ''.join(self.data)
+
+    def key_for_current_object(self):
+        return self.key
+
+    def create_new_object(self, key):
+        return {}
+
+    def update_object(self, existing_object, name):
+        existing_object['stops'] = self.stops
+        existing_object['name'] = self.name
+        self.changes = True
+
+
+class PlainImporter(markup.XMLImporter):
+    """
+    Importer with trivial hooks, measuring the overhead of the engine itself
+    """
+
+    def active_xml_tags(self):
+        return 'trip'
+
+    def observed_xml_tags(self):
+        return 'trip',
+
+
+def feed(trips):
+    element = '<trip id="%d"><stop code="s%d" t="12:00"><name>Station %d</name><x>1</x><y>2</y></stop>' \
+              '<stop code="b"><name>B</name></stop></trip>'
+    return '<feed>%s</feed>' % ''.join(element % (i, i, i) for i in range(trips))
+
+
+def best_of(repeat, function):
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def expat_importer(importer_class):
+    importer = importer_class()
+    importer.use_expat = True
+    return importer
+
+
+def main(trips=30000):
+    document = feed(trips)
+    print 'feed of %d bytes, best of 5' % len(document)
+    for importer_class in (TripImporter, PlainImporter):
+        sax = best_of(5, lambda: xml.sax.parseString(document, importer_class()))
+        expat = best_of(5, lambda: markup.parse_xml(document, expat_importer(importer_class)))
+        print '%s: xml.sax %.3f s, expat %.3f s, speedup %.2f' % (importer_class.__name__, sax, expat, sax / expat)
+
+
+if __name__ == '__main__':
+    main(*[int(argument) for argument in sys.argv[1:]])
@@ -89,6 +89,12 @@ def cet_from_string(string):
 def string_from_cet(a_time):
     return a_time.strftime('%Y-%m-%dT%H:%M:%S')
 
+def utc_from_string(string):
+    return mark_utc(datetime.strptime(string[0:19], '%Y-%m-%dT%H:%M:%S'))
+
+def string_from_utc(a_time):
+    return a_time.strftime('%Y-%m-%dT%H:%M:%S')
+
 def now_utc():
     return datetime.utcnow().replace(tzinfo=UTC())
 
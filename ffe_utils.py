@@ -22,6 +22,9 @@
 
 import re
 import hashlib
+import zlib
+
+CONTENT_ENCODINGS = ('gzip', 'deflate')
 
 
 # ====== Utilities for http authentication =============================================================================
@@ -68,3 +71,103 @@ def auth_header(method, uri, http_response, user):
     auth_params['cnonce'] = cnonce
     auth_params['response'] = response_hash
     return 'Digest %s' % paramslist_from_dict(auth_params)
+
+
+# ====== Utilities for http content ====================================================================================
+
+
+def etag_for_content(content):
+    """
+    Provides a strong entity tag for content
+    """
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    return '"%s"' % hashlib.md5(content).hexdigest()
+
+
+def etag_for_encoding(etag, encoding):
+    """
+    Provides the entity tag for the representation with etag, encoded with a content encoding
+    """
+    if encoding is None:
+        return etag
+    return '%s-%s"' % (etag[:-1], encoding)
+
+
+def identity_etag(etag):
+    """
+    Provides the entity tag of the unencoded representation for an entity tag created by etag_for_encoding
+    """
+    for encoding in CONTENT_ENCODINGS:
+        suffix = '-%s"' % encoding
+        if etag.endswith(suffix):
+            return etag[:-len(suffix)] + '"'
+    return etag
+
+
+def etag_matches(header, etag, weak=True, any_encoding=False):
+    """
+    Evaluates an If-Match or If-None-Match header value against an entity tag
+    :param header: the header value, '*' or a comma separated list of entity tags
+    :param etag: the entity tag of the current representation, None if it has none
+    :param weak: True to use the weak comparison (If-None-Match), False for strong comparison (If-Match)
+    :param any_encoding: True to match tags of the same representation with a different content encoding
+    """
+    if etag is None:
+        return False
+    if header.strip() == '*':
+        return True
+    if any_encoding:
+        etag = identity_etag(etag)
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            if not weak:
+                continue
+            candidate = candidate[2:]
+        if any_encoding:
+            candidate = identity_etag(candidate)
+        if candidate == etag:
+            return True
+    return False
+
+
+def accepted_encoding(header):
+    """
+    Provides the preferred content encoding, acceptable according to an Accept-Encoding header
+    :return: one of CONTENT_ENCODINGS, or None if the content should not be encoded
+    """
+    if not header:
+        return None
+    accepted = set()
+    for item in header.split(','):
+        components = item.split(';')
+        coding = components[0].strip().lower()
+        refused = False
+        for parameter in components[1:]:
+            name, _, value = parameter.partition('=')
+            if name.strip() == 'q':
+                try:
+                    refused = float(value) == 0
+                except ValueError:
+                    refused = True
+        if not refused:
+            accepted.add(coding)
+    for encoding in CONTENT_ENCODINGS:
+        if encoding in accepted:
+            return encoding
+    return None
+
+
+def encoded_content(content, encoding):
+    """
+    Compresses content with a content encoding from CONTENT_ENCODINGS
+    """
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31 writes a gzip header and trailer
+        return compressor.compress(content) + compressor.flush()
+    elif encoding == 'deflate':
+        return zlib.compress(content, 6)
+    return content
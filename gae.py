@@ -33,9 +33,9 @@ def read_counter(identifier):
         value = 0
     return value
 
-def increase_counter(identifier):
+def increase_counter(identifier, delta=1):
     logging.info('increase %s' % identifier)
-    memcache.incr(identifier, initial_value=0)
+    memcache.incr(identifier, delta=delta, initial_value=0)
 
 def counter_dict():
     dictionary = {}
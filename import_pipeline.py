@@ -0,0 +1,290 @@
+# coding=utf-8
+#
+#  Copyright (c) 2014-2015 First Flamingo Enterprise B.V.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  import_pipeline.py
+#  firstflamingo/python_utilities
+#
+
+import logging
+from datetime import datetime
+from xml.parsers import expat
+
+import webapp2
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+from gae import increase_counter, read_counter, issue_tasks, task_name, remote_fetch
+from markup import escape_attribute, escape_text, parse_xml, xml_chunks
+
+
+# ====== Import runs ===================================================================================================
+
+
+class ImportRun(ndb.Model):
+    """
+    ImportRun imports a large xml feed with an XMLImporter in parallel tasks:
+    1) start() issues a task that fetches the feed and splits it into ImportChunk entities with batch_size
+       active elements each, and issues a named task per chunk
+    2) each chunk task imports its chunk and records the keys it has seen
+    3) a final reconcile task, retried until all chunks are done, provides the keys of the existing objects that
+       don't appear in the feed to save_objects() of the importer
+    The importer must use windowed import (window_size), it will see a document with root element 'chunk'
+    containing the active elements. Progress is tracked in counters, see progress().
+    ImportTaskHandler must be routed to task_url.
+    """
+    url = ndb.TextProperty()
+    importer_module = ndb.StringProperty(indexed=False)
+    importer_name = ndb.StringProperty(indexed=False)
+    chunk_count = ndb.IntegerProperty(indexed=False)
+    started = ndb.DateTimeProperty(indexed=False)
+    finished = ndb.DateTimeProperty(indexed=False)
+
+    task_url = '/_tasks/import'
+    batch_size = 200
+    put_batch_size = 20
+    reconcile_delay = 60
+    fetch_deadline = 60
+
+    # ------------ Starting an import ----------------------------------------------------------------------------------
+
+    @classmethod
+    def start(cls, importer_class, url):
+        """
+        Starts the import of the feed at url, with a task that fetches and splits the feed
+        :rtype : ImportRun
+        """
+        if not importer_class.window_size:
+            raise ValueError('%s does not use windowed import' % importer_class.__name__)
+        started = datetime.utcnow()
+        run_id = '%s_%s' % (importer_class.__name__, started.strftime('%Y%m%d%H%M%S'))
+        run = cls(id=run_id, url=url, importer_module=importer_class.__module__,
+                  importer_name=importer_class.__name__, started=started)
+        run.put()
+        issue_tasks([run.split_task()])
+        return run
+
+    def split(self):
+        """
+        Fetches the feed, splits it into chunks and issues the import tasks.
+        A retried task stores the same chunks again, the tasks are named so they are issued once.
+        :return: False if the feed could not be fetched
+        """
+        source = remote_fetch(self.url, deadline=self.fetch_deadline)
+        if source is None:
+            return False
+        run_id = self.key.id()
+        splitter = FeedSplitter(self.importer_class().active_tag_set(), self.batch_size)
+        chunk_count = 0
+        chunks = []
+        for content in splitter.split(source):
+            chunks.append(ImportChunk(id=ImportChunk.chunk_id(run_id, chunk_count), run=run_id, content=content))
+            chunk_count += 1
+            if len(chunks) >= self.put_batch_size:
+                ndb.put_multi(chunks)
+                chunks = []
+        ndb.put_multi(chunks)
+        self.chunk_count = chunk_count
+        self.put()
+        logging.info('Import %s split into %d chunks' % (run_id, chunk_count))
+        tasks = [self.chunk_task(index) for index in range(chunk_count)]
+        tasks.append(self.reconcile_task())
+        issue_tasks(tasks)
+        return True
+
+    def split_task(self):
+        return taskqueue.Task(url=self.task_url, name=task_name(self.started, 'split_%s' % self.key.id()),
+                              params={'run': self.key.id(), 'split': 1})
+
+    def chunk_task(self, index):
+        return taskqueue.Task(url=self.task_url, name=task_name(self.started, 'import_%s_%d' % (self.key.id(), index)),
+                              params={'run': self.key.id(), 'chunk': index})
+
+    def reconcile_task(self):
+        return taskqueue.Task(url=self.task_url, name=task_name(self.started, 'reconcile_%s' % self.key.id()),
+                              params={'run': self.key.id()}, countdown=self.reconcile_delay)
+
+    # ------------ Running the tasks -----------------------------------------------------------------------------------
+
+    @property
+    def importer_class(self):
+        module = __import__(self.importer_module)
+        return getattr(module, self.importer_name)
+
+    def import_chunk(self, index):
+        """
+        Imports a chunk, chunks that are already done (e.g. by a retried task) are ignored
+        """
+        chunk = ImportChunk.get_by_id(ImportChunk.chunk_id(self.key.id(), index))
+        if chunk is None or chunk.done:
+            return
+        importer = self.importer_class()
+        importer.partial_import = True
+        parse_xml(chunk.content, importer)
+        chunk.seen_keys = list(importer.seen_keys)
+        chunk.content = None
+        chunk.done = True
+        chunk.put()
+        increase_counter(self.counter_name('chunks'))
+        increase_counter(self.counter_name('skipped'), importer.skipped_count)
+        increase_counter(self.counter_name('changed'), importer.changed_count)
+        increase_counter(self.counter_name('new'), importer.new_count)
+
+    def reconcile(self):
+        """
+        Provides the keys of the existing objects that don't appear in the feed to save_objects() of the importer,
+        when all chunks are done. The chunks are deleted afterwards.
+        :return: True if the import is finished, False if chunks are pending
+        """
+        if self.finished is not None:
+            return True
+        if self.chunk_count is None:
+            return False
+        if ImportChunk.query(ImportChunk.run == self.key.id(), ImportChunk.done == False).get(keys_only=True):
+            return False
+        chunks = ndb.get_multi(self.chunk_keys())
+        seen_keys = set()
+        for chunk in chunks:
+            if chunk is None or not chunk.done:
+                return False
+            seen_keys.update(chunk.seen_keys)
+        importer = self.importer_class()
+        importer.old_objects = {}
+        importer.updated_objects = {}
+        importer.new_objects = {}
+        importer.missing_keys = frozenset(importer.existing_keys()) - seen_keys
+        importer.save_objects()
+        self.finished = datetime.utcnow()
+        self.put()
+        ndb.delete_multi(self.chunk_keys())
+        logging.info('Import %s finished, %d objects missing' % (self.key.id(), len(importer.missing_keys)))
+        return True
+
+    def chunk_keys(self):
+        return [ndb.Key(ImportChunk, ImportChunk.chunk_id(self.key.id(), index)) for index in range(self.chunk_count)]
+
+    # ------------ Progress --------------------------------------------------------------------------------------------
+
+    def counter_name(self, label):
+        return 'import_%s_%s' % (self.key.id(), label)
+
+    def progress(self):
+        dictionary = {'chunk_count': self.chunk_count, 'finished': self.finished is not None}
+        for label in ('chunks', 'skipped', 'changed', 'new'):
+            dictionary[label] = read_counter(self.counter_name(label))
+        return dictionary
+
+
+class ImportChunk(ndb.Model):
+    """
+    ImportChunk holds a part of the feed of an ImportRun, until it has been imported,
+    and the keys of the objects it contained
+    """
+    run = ndb.StringProperty()
+    done = ndb.BooleanProperty(default=False)
+    content = ndb.BlobProperty(compressed=True)
+    seen_keys = ndb.JsonProperty(compressed=True)
+
+    @staticmethod
+    def chunk_id(run_id, index):
+        return '%s_%06d' % (run_id, index)
+
+
+class ImportTaskHandler(webapp2.RequestHandler):
+    """
+    Handles the tasks of an ImportRun. The split task is answered with 503, to be retried, when the feed can't be
+    fetched, the reconcile task while chunks are pending.
+    """
+
+    def post(self):
+        run = ImportRun.get_by_id(self.request.get('run'))
+        if run is None:
+            logging.warning('Import %s not found' % self.request.get('run'))
+            return
+        chunk = self.request.get('chunk')
+        if self.request.get('split'):
+            if not run.split():
+                self.response.status_int = 503  # Service Unavailable
+        elif chunk:
+            run.import_chunk(int(chunk))
+        elif not run.reconcile():
+            self.response.status_int = 503  # Service Unavailable
+
+
+# ====== Splitting feeds ===============================================================================================
+
+
+class FeedSplitter(object):
+    """
+    Splits an xml feed into utf-8 encoded documents with root element 'chunk' and batch_size active elements each.
+    Only the active elements and their content are kept.
+    """
+
+    def __init__(self, active_tags, batch_size):
+        self.active_tags = active_tags
+        self.batch_size = batch_size
+        self.depth = 0
+        self.parts = []
+        self.count = 0
+        self.batches = []
+        self.parser = expat.ParserCreate()
+        self.parser.buffer_text = True
+        self.parser.StartElementHandler = self.start_element
+        self.parser.EndElementHandler = self.end_element
+        self.parser.CharacterDataHandler = self.characters
+
+    def split(self, source):
+        """
+        Generator providing the documents, while the source (a string, file-like object or iterator of chunks) is read
+        """
+        for data in xml_chunks(source):
+            self.parser.Parse(data, False)
+            for batch in self.pop_batches():
+                yield batch
+        self.parser.Parse('', True)
+        self.close_batch()
+        for batch in self.pop_batches():
+            yield batch
+
+    def pop_batches(self):
+        batches, self.batches = self.batches, []
+        return batches
+
+    def start_element(self, name, attrs):
+        if self.depth or name in self.active_tags:
+            self.depth += 1
+            items = [u'<', name]
+            for key, value in attrs.items():
+                items.extend((u' ', key, u'="', escape_attribute(value), u'"'))
+            items.append(u'>')
+            self.parts.append(u''.join(items))
+
+    def end_element(self, name):
+        if self.depth:
+            self.parts.append(u'</%s>' % name)
+            self.depth -= 1
+            if not self.depth:
+                self.count += 1
+                if self.count >= self.batch_size:
+                    self.close_batch()
+
+    def characters(self, string):
+        if self.depth:
+            self.parts.append(escape_text(string))
+
+    def close_batch(self):
+        if self.count:
+            self.batches.append((u'<chunk>%s</chunk>' % u''.join(self.parts)).encode('utf-8'))
+        self.parts = []
+        self.count = 0
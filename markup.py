@@ -21,30 +21,68 @@
 #
 
 from google.appengine.api import users
+from google.appengine.ext import ndb
+import hashlib
 import logging
 import xml.sax
+from xml.parsers import expat
+
+_END = object()
 
 # ====== Generic XML Classes ===========================================================================================
 
-class XMLElement:
+class XMLElement(object):
+    """
+    XML element, kept compact for large trees: no instance dictionary, tag and attribute names are interned and
+    empty attributes and content are shared until the element is modified.
+    """
+    __slots__ = ('_type', '_attributes', '_content')
+    
     OPEN_TEMPLATE           = '<%s>'
     CLOSE_TEMPLATE          = '</%s>'
     SELFCLOSING_TEMPLATE    = '<%s/>'
     ATTRIBUTE_TEMPLATE      = '%s="%s"'
+    NO_ATTRIBUTES           = None
+    NO_CONTENT              = ()
     
     def __init__(self, type, attributes=None, content=None):
         self.type = type
-        if attributes == None:
-            self.attributes = {}
-        else:
-            self.attributes = attributes
-        if content == None:
-            self.content = []
+        self._attributes = attributes or XMLElement.NO_ATTRIBUTES
+        if content is None or content == []:
+            self._content = XMLElement.NO_CONTENT
         else:
-            self.content = content
+            self._content = content
+    
+    @property
+    def type(self):
+        return self._type
+    
+    @type.setter
+    def type(self, value):
+        self._type = interned(value)
+    
+    @property
+    def attributes(self):
+        if self._attributes is XMLElement.NO_ATTRIBUTES:
+            self._attributes = {}
+        return self._attributes
+    
+    @attributes.setter
+    def attributes(self, value):
+        self._attributes = value
+    
+    @property
+    def content(self):
+        if self._content is XMLElement.NO_CONTENT:
+            self._content = []
+        return self._content
+    
+    @content.setter
+    def content(self, value):
+        self._content = value
     
     def set_attribute(self, key, value):
-        self.attributes[key] = value
+        self.attributes[interned(key)] = value
     
     def set_time(self, timeStamp):
         self.set_attribute('time', rfc3339String(timeStamp))
@@ -53,28 +91,67 @@ class XMLElement:
         self.content.append(newContent)
     
     def write(self, depth=0, lf=False):
-        if depth > 10: raise Exception('exceeds max recurse depth %d' % depth)
-        list = [self.type]
-        for key, value in self.attributes.items():
-            list.append(XMLElement.ATTRIBUTE_TEMPLATE % (key, value))
-        attributed_type = ' '.join(list)
-        list = []
-        if self.content:
-            list.append(XMLElement.OPEN_TEMPLATE % attributed_type)
-            for element in self.content:
-                try:
-                    theString = element.write(depth + 1, lf=lf)
-                    list.append(theString)
-                except AttributeError:
-                    list.append(unicode(element))
-            list.append(XMLElement.CLOSE_TEMPLATE % self.type)
-            if lf:
-                joinString = '\n' + depth * ' '
+        return u''.join(self.chunks(depth, lf=lf))
+    
+    def write_to(self, out, depth=0, lf=False):
+        """
+        Writes the serialization into a file-like object, e.g. a webapp2 response.out
+        """
+        for chunk in self.chunks(depth, lf=lf):
+            out.write(chunk)
+    
+    def attributed_type(self):
+        if not self._attributes:
+            return self._type
+        list = [self._type]
+        for key, value in self._attributes.items():
+            list.append(XMLElement.ATTRIBUTE_TEMPLATE % (key, escape_attribute(value)))
+        return ' '.join(list)
+    
+    def chunks(self, depth=0, lf=False):
+        """
+        Generator providing the serialization in chunks, without building intermediate strings.
+        The tree is walked with an explicit stack, so there is no limit to its depth.
+        Text content is escaped, except RawMarkup. Slots are yielded as is, to be compiled by a Template.
+        Content can be any iterable, also a generator.
+        Other objects with a chunks(depth, lf) method (e.g. HTMLTable) can be part of the content, objects with only
+        a write(depth, lf) method returning markup are written with that method.
+        """
+        stack = []
+        element, element_depth = self, depth
+        while True:
+            child = _END
+            if element is not None:
+                content = iter(element._content)
+                child = next(content, _END)
+                if child is _END:
+                    yield XMLElement.SELFCLOSING_TEMPLATE % element.attributed_type()
+                else:
+                    yield XMLElement.OPEN_TEMPLATE % element.attributed_type()
+                    separator = '\n' + element_depth * ' ' if lf else ''
+                    stack.append((element, content, element_depth, separator))
+                element = None
+            if not stack:
+                return
+            parent, content, parent_depth, separator = stack[-1]
+            if child is _END:
+                child = next(content, _END)
+            if separator:
+                yield separator
+            if child is _END:
+                stack.pop()
+                yield XMLElement.CLOSE_TEMPLATE % parent._type
+            elif isinstance(child, XMLElement):
+                element, element_depth = child, parent_depth + 1
+            elif hasattr(child, 'chunks'):
+                for chunk in child.chunks(parent_depth + 1, lf=lf):
+                    yield chunk
+            elif hasattr(child, 'write'):
+                yield RawMarkup(child.write(parent_depth + 1, lf=lf))
+            elif isinstance(child, (RawMarkup, Slot)):
+                yield child
             else:
-                joinString = ''
-            return joinString.join(list)
-        else:
-            return XMLElement.SELFCLOSING_TEMPLATE % attributed_type
+                yield escape_text(child)
 
 class XMLDocument:
     
@@ -85,11 +162,40 @@ class XMLDocument:
         return '<?xml version="1.0" encoding="UTF-8"?>'
     
     def write(self, lf=False):
+        return u''.join(self.chunks(lf=lf))
+    
+    def write_to(self, out, lf=False):
+        """
+        Writes the document into a file-like object, e.g. a webapp2 response.out
+        """
+        for chunk in self.chunks(lf=lf):
+            out.write(chunk)
+    
+    def chunks(self, lf=False):
+        yield self.doctype()
         if lf:
-            joinString = '\n'
-        else:
-            joinString = ''
-        return joinString.join([self.doctype(), self.root.write(lf=lf)])
+            yield '\n'
+        for chunk in self.root.chunks(lf=lf):
+            yield chunk
+
+class RawMarkup(unicode):
+    """
+    Marks a string as markup, it will be written without escaping
+    """
+    pass
+
+def interned(name):
+    if type(name) is str:
+        return intern(name)
+    return name
+
+def escape_text(value):
+    if not isinstance(value, basestring):
+        value = unicode(value)
+    return value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+def escape_attribute(value):
+    return escape_text(value).replace('"', '&quot;')
 
 # ====== Functions creating XML elements ===============================================================================
 
@@ -110,6 +216,10 @@ class XMLImporter(xml.sax.handler.ContentHandler):
     The actual reading of the data will be done in a subclass implementation of start_xml_element and end_xml_element
     Fetched data must be (temporarily) stored in attributes of the Importer
     Results must be saved in endDocument()
+    For large data sets a subclass can set window_size for a windowed import, existing objects are then loaded
+    in slices through existing_keys() and existing_objects_slice() and updated objects are saved in batches.
+    A subclass can set fingerprint_attribute to the name of an attribute of its objects that stores a digest of
+    the xml element they were imported from. Objects with an unchanged digest are skipped without update_object().
     The following methods must be implemented in subclasses:
     active_xml_tags()
     existing_objects_dictionary()
@@ -118,6 +228,11 @@ class XMLImporter(xml.sax.handler.ContentHandler):
     start_xml_element(name, attrs)
     end_xml_element(name)
     update_object(existing_object)
+    The importer is run by xml.sax, subclasses can set use_expat to be run by parse_xml() with a faster engine that
+    drives expat directly (parse_string(), parse(), feed() and close()). This engine doesn't call startElement(),
+    endElement() and characters(), so subclasses must not override those. With expat only the elements named by
+    observed_xml_tags() and the active tags are passed to start_xml_element() and end_xml_element(), attrs is then
+    a plain dict and data is a reused list with the text since the start of the last of those elements.
     """
 
     data = None
@@ -125,36 +240,285 @@ class XMLImporter(xml.sax.handler.ContentHandler):
     old_objects = None
     updated_objects = None
     new_objects = None
+    use_expat = False
+    _active_tags = None
+    observed_tags = None
+    window_size = None
+    window_start = None
+    window_end = None
+    known_keys = None
+    seen_keys = None
+    missing_keys = None
+    partial_import = False
+    fingerprint_attribute = None
+    digest = None
+    skipped_count = 0
+    changed_count = 0
+    new_count = 0
 
     def startDocument(self):
-        self.old_objects = self.existing_objects_dictionary()
+        self._active_tags = self.active_tag_set()
+        observed = self.observed_xml_tags()
+        if observed is not None:
+            self.observed_tags = frozenset(observed) | self.active_tags
+        if self.window_size:
+            if not self.partial_import:
+                self.known_keys = frozenset(self.existing_keys())
+            self.seen_keys = set()
+            self.old_objects = {}
+            self.window_start = None
+        else:
+            self.old_objects = self.existing_objects_dictionary()
         self.updated_objects = {}
         self.new_objects = {}
+        self.digest = None
+        self.skipped_count = 0
+        self.changed_count = 0
+        self.new_count = 0
 
     def endDocument(self):
+        if self.window_size:
+            self.flush_objects()
+            if not self.partial_import:
+                self.missing_keys = self.known_keys - self.seen_keys
+        logging.info('%s: %d objects skipped, %d changed (of which %d new)' %
+                     (self.__class__.__name__, self.skipped_count, self.changed_count, self.new_count))
         self.save_objects()
 
     def startElement(self, name, attrs):
+        if self.fingerprint_attribute:
+            self.digest_start(name, attrs)
         self.data = []
         self.start_xml_element(name, attrs)
 
     def endElement(self, name):
-        if name in self.active_xml_tags():
-            key = self.key_for_current_object()
-            if key is not None:
-                current_object = self.pop_from_old_objects(key)
-                if not current_object:
-                    current_object = self.create_new_object(key)
-                self.changes = False
-                self.update_object(current_object, name)
-                self.new_objects[key] = current_object
-                if self.changes:
-                    self.updated_objects[key] = current_object
+        if self.fingerprint_attribute:
+            self.digest_end(name)
+        if name in self.active_tags:
+            self.import_current_object(name)
         self.end_xml_element(name)
 
     def characters(self, string):
+        if self.fingerprint_attribute:
+            self.digest_text(string)
         self.data.append(string)
 
+    def import_current_object(self, name):
+        key = self.key_for_current_object()
+        fingerprint = self.current_fingerprint()
+        if key is not None:
+            if self.window_size:
+                if self.known_keys is None or key in self.known_keys:
+                    self.move_window(key)
+                self.seen_keys.add(key)
+            current_object = self.pop_from_old_objects(key)
+            if not current_object:
+                current_object = self.create_new_object(key)
+                self.new_count += 1
+            elif fingerprint is not None and getattr(current_object, self.fingerprint_attribute, None) == fingerprint:
+                self.new_objects[key] = current_object
+                self.skipped_count += 1
+                return
+            self.changes = False
+            self.update_object(current_object, name)
+            if fingerprint is not None and getattr(current_object, self.fingerprint_attribute, None) != fingerprint:
+                setattr(current_object, self.fingerprint_attribute, fingerprint)
+                self.changes = True
+            self.new_objects[key] = current_object
+            if self.changes:
+                self.updated_objects[key] = current_object
+                self.changed_count += 1
+            if self.window_size and len(self.new_objects) >= self.window_size:
+                self.flush_objects()
+
+    @property
+    def active_tags(self):
+        """
+        The active tags as a frozenset, set by startDocument() or computed when a subclass doesn't call it
+        """
+        if self._active_tags is None:
+            self._active_tags = self.active_tag_set()
+        return self._active_tags
+
+    def active_tag_set(self):
+        tags = self.active_xml_tags()
+        if tags is None:
+            return frozenset()
+        if isinstance(tags, basestring):
+            return frozenset([tags])
+        return frozenset(tags)
+
+    # ------------ Windowed import -------------------------------------------------------------------------------------
+
+    def move_window(self, key):
+        """
+        Makes sure the existing object for key is loaded, by loading the slice of existing objects starting at key
+        when key lies outside the current window, or was imported before and already saved.
+        Key-ordered feeds load every existing object once.
+        """
+        if key in self.old_objects or key in self.new_objects:
+            return
+        if key not in self.seen_keys and self.key_in_window(key):
+            return
+        self.flush_objects()
+        self.old_objects = self.existing_objects_slice(key, self.window_size)
+        self.window_start = key
+        if len(self.old_objects) >= self.window_size:
+            self.window_end = max(self.old_objects)
+        else:
+            self.window_end = None
+
+    def key_in_window(self, key):
+        if self.window_start is None or key < self.window_start:
+            return False
+        return self.window_end is None or key <= self.window_end
+
+    def flush_objects(self):
+        if self.updated_objects:
+            self.save_batch(self.updated_objects.values())
+        self.updated_objects = {}
+        self.new_objects = {}
+
+    # ------------ Change detection ------------------------------------------------------------------------------------
+
+    def digest_start(self, name, attrs):
+        if name in self.active_tags:
+            self.digest = hashlib.md5()
+        if self.digest is not None:
+            items = [u'<', name]
+            for key, value in sorted(attrs.items()):
+                items.extend((u' ', key, u'="', value, u'"'))
+            items.append(u'>')
+            self.digest.update(u''.join(items).encode('utf-8'))
+
+    def digest_end(self, name):
+        if self.digest is not None:
+            self.digest.update((u'</%s>' % name).encode('utf-8'))
+
+    def digest_text(self, string):
+        if self.digest is not None:
+            self.digest.update(string.encode('utf-8'))
+
+    def current_fingerprint(self):
+        """
+        Provides the digest of the attributes and text of the active element that just ended, or None
+        """
+        if self.digest is None:
+            return None
+        fingerprint = self.digest.hexdigest()
+        self.digest = None
+        return fingerprint
+
+    # ------------ Expat engine ----------------------------------------------------------------------------------------
+
+    parser = None
+
+    def parse_string(self, string):
+        """
+        Imports an xml string with expat, without the per-event overhead of xml.sax
+        """
+        self.feed(string)
+        self.close()
+
+    def parse(self, source):
+        """
+        Imports xml from a string, a file-like object or an iterator of chunks (e.g. a generator),
+        feeding the chunks to expat as they are read, so the document is never held in memory as a whole
+        """
+        for chunk in xml_chunks(source):
+            self.feed(chunk)
+        self.close()
+
+    def feed(self, chunk):
+        """
+        Incremental import: feeds the next chunk of the document, the import is completed by close()
+        """
+        if self.parser is None:
+            self.startDocument()
+            self.parser = self.expat_parser()
+        self.parser.Parse(chunk, False)
+
+    def close(self):
+        if self.parser is None:
+            self.startDocument()
+            self.parser = self.expat_parser()
+        parser, self.parser = self.parser, None
+        parser.Parse('', True)
+        self.endDocument()
+
+    def expat_parser(self):
+        """
+        Provides an expat parser with handlers bound to the tag sets and hooks, to keep the work per event minimal:
+        attributes are passed as expat's dict, text is collected in one list (self.data, emptied at the start of
+        an observed element) by a builtin, and hooks that aren't overridden are not called.
+        """
+        parser = expat.ParserCreate()
+        parser.buffer_text = True
+        active_tags = self.active_tags
+        observed_tags = self.observed_tags
+        start_hook = self.overridden_hook('start_xml_element')
+        end_hook = self.overridden_hook('end_xml_element')
+        import_current_object = self.import_current_object
+        data = self.data = []
+        collect = data.append
+        digest_start = digest_end = digest_text = None
+        if self.fingerprint_attribute:
+            digest_start, digest_end, digest_text = self.digest_start, self.digest_end, self.digest_text
+
+        if observed_tags is None:
+            def start_element(name, attrs):
+                if digest_start:
+                    digest_start(name, attrs)
+                del data[:]
+                if start_hook:
+                    start_hook(name, attrs)
+
+            def end_element(name):
+                if digest_end:
+                    digest_end(name)
+                if name in active_tags:
+                    import_current_object(name)
+                if end_hook:
+                    end_hook(name)
+        else:
+            def start_element(name, attrs):
+                if digest_start:
+                    digest_start(name, attrs)
+                if name in observed_tags:
+                    del data[:]
+                    if start_hook:
+                        start_hook(name, attrs)
+
+            def end_element(name):
+                if digest_end:
+                    digest_end(name)
+                if name in observed_tags:
+                    if name in active_tags:
+                        import_current_object(name)
+                    if end_hook:
+                        end_hook(name)
+
+        if digest_text:
+            def characters(string):
+                digest_text(string)
+                collect(string)
+        else:
+            characters = collect
+
+        parser.StartElementHandler = start_element
+        parser.EndElementHandler = end_element
+        parser.CharacterDataHandler = characters
+        return parser
+
+    def overridden_hook(self, name):
+        """
+        Provides the bound method name if a subclass overrides it, otherwise None
+        """
+        method = getattr(self, name)
+        if getattr(method, 'im_func', None) is getattr(XMLImporter, name).im_func:
+            return None
+        return method
+
     def pop_from_old_objects(self, key):
         current_object = self.old_objects.get(key)
         if current_object:
@@ -165,12 +529,19 @@ class XMLImporter(xml.sax.handler.ContentHandler):
 
     def active_xml_tags(self):
         """
-        Provides the name of the xml element that encapsulates the objects that must be imported.
-        Must be overwritten in subclasses
+        Provides the name of the xml element that encapsulates the objects that must be imported,
+        or a collection of names. Must be overwritten in subclasses
 
         """
         return None
 
+    def observed_xml_tags(self):
+        """
+        Provides the names of the xml elements that must be passed to start_xml_element and end_xml_element
+        by the expat engine, next to the active tags (by default none). None passes all elements.
+        """
+        return ()
+
     def existing_objects_dictionary(self):
         """
         Provides a dictionary with the objects that will be updated by the import.
@@ -179,6 +550,21 @@ class XMLImporter(xml.sax.handler.ContentHandler):
         """
         return {}
 
+    def existing_keys(self):
+        """
+        Windowed import: provides the keys of all objects that could be updated by the import.
+        Must be overwritten in subclasses that set window_size
+        """
+        return []
+
+    def existing_objects_slice(self, start_key, limit):
+        """
+        Windowed import: provides a dictionary with the first limit existing objects, in key order,
+        with a key equal to or following start_key.
+        Must be overwritten in subclasses that set window_size
+        """
+        return {}
+
     def key_for_current_object(self):
         """
         Provides the key to store the current object. If 'None' is returned the current object will be ignored.
@@ -218,10 +604,53 @@ class XMLImporter(xml.sax.handler.ContentHandler):
     def save_objects(self):
         """
         Gives subclasses the opportunity to save the imported objects.
+        In a windowed import the updated objects have already been saved with save_batch(), missing_keys then
+        holds the keys of the existing objects that don't appear in the xml. If partial_import is set, the xml is
+        only a part of the feed: existing_keys() is not called, only the slices of existing objects the xml touches
+        are loaded and missing_keys remains None.
         Must be overwritten in subclasses
         """
         pass
 
+    def save_batch(self, objects):
+        """
+        Windowed import: saves a batch of at most window_size updated objects, by default with ndb.put_multi
+        """
+        ndb.put_multi(objects)
+
+
+def parse_xml(source, handler):
+    """
+    Parses xml from a string, a file-like object or an iterator of chunks,
+    with the expat engine if handler is an XMLImporter that sets use_expat, otherwise with xml.sax
+    """
+    if isinstance(handler, XMLImporter) and handler.use_expat:
+        handler.parse(source)
+    elif isinstance(source, basestring):
+        xml.sax.parseString(source, handler)
+    else:
+        parser = xml.sax.make_parser()
+        parser.setContentHandler(handler)
+        for chunk in xml_chunks(source):
+            parser.feed(chunk)
+        parser.close()
+
+
+def xml_chunks(source, chunk_size=65536):
+    """
+    Provides the chunks of a string, a file-like object or an iterator of chunks
+    """
+    if isinstance(source, basestring):
+        yield source
+    elif hasattr(source, 'read'):
+        chunk = source.read(chunk_size)
+        while chunk:
+            yield chunk
+            chunk = source.read(chunk_size)
+    else:
+        for chunk in source:
+            yield chunk
+
 # ====== Generic HTML Classes ==========================================================================================
 
 class HTMLDocument(XMLDocument):
@@ -240,6 +669,12 @@ class HTMLDocument(XMLDocument):
         return '<!doctype html>'
 
 class HTMLTable():
+    """
+    HTML table with a header of column titles.
+    Rows can be added one by one, filled from data with fill_data() or streamed from data with stream_data().
+    """
+    format = None
+    data = None
     
     def __init__(self, name, columnTitles):
         self.name = name
@@ -258,12 +693,38 @@ class HTMLTable():
     def fill_data(self, data):
         if not self.format: return
         for dataRow in data:
-            tableRow = self.add_row()
-            for col in range(len(dataRow)):
-                if col >= len(self.format): break
-                tableRow.add_to_cell(col, self.format[col] % dataRow[col])
+            self.rows.append(self.formatted_row(dataRow))
     
-    def write(self, depth, lf=False):
+    def stream_data(self, data):
+        """
+        Sets an iterable of data rows, e.g. a generator or a query, to be formatted with format while the table is
+        written, after the rows already added. Only one row is kept in memory, the data can be iterated once.
+        """
+        self.data = data
+    
+    def add_to_column(self, index, values):
+        """
+        Adds values to the cells in column index of the rows added so far, e.g. the result of date_column().
+        None values are skipped.
+        """
+        for row, value in zip(self.rows, values):
+            if value is not None:
+                row.add_to_cell(index, value)
+    
+    def formatted_row(self, dataRow):
+        tableRow = HTMLTableRow(self.width)
+        for col in range(min(len(dataRow), len(self.format))):
+            tableRow.add_to_cell(col, self.format[col] % dataRow[col])
+        return tableRow
+    
+    def row_elements(self):
+        for row in self.rows:
+            yield XMLElement('tr', content=row.cells)
+        if self.data is not None and self.format:
+            for dataRow in self.data:
+                yield XMLElement('tr', content=self.formatted_row(dataRow).cells)
+    
+    def element(self):
         root = element_with_id('table', self.name)
         colgroup = XMLElement('colgroup')
         table_head = XMLElement('tr')
@@ -274,16 +735,17 @@ class HTMLTable():
             i += 1
         root.add(colgroup)
         root.add(XMLElement('thead', {}, [table_head]))
-        table_body = XMLElement('tbody')
-        for row in self.rows:
-            row_object = XMLElement('tr')
-            for cell in row.cells:
-                row_object.add(cell)
-            table_body.add(row_object)
-        root.add(table_body)
-        return root.write(depth, lf=lf)
+        root.add(XMLElement('tbody', content=self.row_elements()))
+        return root
+    
+    def write(self, depth, lf=False):
+        return self.element().write(depth, lf=lf)
+    
+    def chunks(self, depth=0, lf=False):
+        return self.element().chunks(depth, lf=lf)
 
-class HTMLTableRow():
+class HTMLTableRow(object):
+    __slots__ = ('cells',)
     
     def __init__(self, width):
         self.cells = [''] * width
@@ -332,7 +794,14 @@ def heading(level, text, attributes={}):
     return XMLElement(type, attributes, [text])
 
 def table_cell(column_index):
-    return XMLElement('td', {'class': 'C%02d' % column_index}, [])
+    return XMLElement('td', {'class': column_class(column_index)})
+
+_column_classes = []
+
+def column_class(column_index):
+    while len(_column_classes) <= column_index:
+        _column_classes.append(intern('C%02d' % len(_column_classes)))
+    return _column_classes[column_index]
 
 def form(action, method='get'):
     return XMLElement('form', {'action':action, 'method':method}, [])
@@ -344,29 +813,43 @@ def input(type, name=None, value=None, size=None):
     if size: attributes['size'] = size
     return XMLElement('input', attributes, [])
 
+MONTH_NAMES = ('jan', 'feb', 'mrt', 'apr', 'mei', 'jun', 'jul', 'aug', 'sep', 'okt', 'nov', 'dec')
+MAX_TIME_FORMATS = 10000
+_time_formats = {}
+
 def date(timeStamp):
-    m = timeStamp.month
-    if m ==  1: monthName = 'jan'
-    if m ==  2: monthName = 'feb'
-    if m ==  3: monthName = 'mrt'
-    if m ==  4: monthName = 'apr'
-    if m ==  5: monthName = 'mei'
-    if m ==  6: monthName = 'jun'
-    if m ==  7: monthName = 'jul'
-    if m ==  8: monthName = 'aug'
-    if m ==  9: monthName = 'sep'
-    if m == 10: monthName = 'okt'
-    if m == 11: monthName = 'nov'
-    if m == 12: monthName = 'dec'
-    userString = '%d %s.\'%02d' % (timeStamp.day, monthName, timeStamp.year - 2000)
-    return XMLElement('time', {'datetime':rfc3339String(timeStamp)}, [userString])
+    rfc3339, userString, _ = time_formats(timeStamp)
+    return XMLElement('time', {'datetime': rfc3339}, [userString])
 
 def time(timeStamp):
-    userString = '%02d:%02d:%02d' % (timeStamp.hour, timeStamp.minute, timeStamp.second)
-    return XMLElement('time', {'datetime':rfc3339String(timeStamp)}, [userString])
+    rfc3339, _, userString = time_formats(timeStamp)
+    return XMLElement('time', {'datetime': rfc3339}, [userString])
+
+def date_column(timeStamps):
+    return [date(timeStamp) if timeStamp is not None else None for timeStamp in timeStamps]
+
+def time_column(timeStamps):
+    return [time(timeStamp) if timeStamp is not None else None for timeStamp in timeStamps]
 
 def rfc3339String(t):
-    return '%04d-%02d-%02dT%02d:%02d:%02dZ' % (t.year, t.month, t.day, t.hour, t.minute, t.second)
+    return time_formats(t)[0]
+
+def time_formats(t):
+    """
+    Provides the rfc3339 string, the date string and the time string of a timestamp.
+    The strings are remembered by the formatted fields, as timestamps tend to repeat in tables.
+    (Not by the timestamp itself: aware timestamps in different time zones can be equal.)
+    """
+    key = (t.year, t.month, t.day, t.hour, t.minute, t.second)
+    formats = _time_formats.get(key)
+    if formats is None:
+        if len(_time_formats) >= MAX_TIME_FORMATS:
+            _time_formats.clear()
+        formats = ('%04d-%02d-%02dT%02d:%02d:%02dZ' % (t.year, t.month, t.day, t.hour, t.minute, t.second),
+                   '%d %s.\'%02d' % (t.day, MONTH_NAMES[t.month - 1], t.year - 2000),
+                   '%02d:%02d:%02d' % (t.hour, t.minute, t.second))
+        _time_formats[key] = formats
+    return formats
 
 # ====== HTML template functions =======================================================================================
 
@@ -376,8 +859,7 @@ def login_link():
 def user_id():
     user = users.get_current_user().nickname()
     logout_link = anchor(users.create_logout_url('/'), 'logout')
-    content = '<b>%s</b> | %s' % (user, logout_link.write())
-    return XMLElement('div', {'id': 'user_id'}, [content])
+    return XMLElement('div', {'id': 'user_id'}, [XMLElement('b', content=[user]), ' | ', logout_link])
 
 def main_menu(menu_list):
     list = XMLElement('ul')
@@ -397,7 +879,7 @@ def page_navigator(currentPage, lastPage, urlFormat):
     if before > 0:
         par.add(link_to_page(urlFormat, currentPage - 1))
         par.add(' ')
-    par.add('<strong>%d</strong>' % currentPage)
+    par.add(XMLElement('strong', content=['%d' % currentPage]))
     if after > 0:
         par.add(' ')
         par.add(link_to_page(urlFormat, currentPage + 1))
@@ -407,3 +889,74 @@ def page_navigator(currentPage, lastPage, urlFormat):
         par.add(' ')
         par.add(link_to_page(urlFormat, lastPage))
     return par
+
+# ====== Compiled templates ============================================================================================
+
+class Slot(object):
+    """
+    Placeholder for a dynamic part of a Template, to be used as content of an XMLElement.
+    kind TEXT accepts a string, which will be escaped.
+    kind MARKUP accepts an XMLElement, an object with a chunks() method (e.g. HTMLTable) or RawMarkup.
+    """
+    __slots__ = ('name', 'kind')
+    TEXT = 'text'
+    MARKUP = 'markup'
+    
+    def __init__(self, name, kind=TEXT):
+        self.name = name
+        self.kind = kind
+    
+    def render(self, value, lf=False):
+        if value is None:
+            return ''
+        if self.kind == Slot.TEXT:
+            return escape_text(value)
+        if hasattr(value, 'chunks'):
+            return u''.join(value.chunks(lf=lf))
+        if isinstance(value, RawMarkup):
+            return value
+        raise TypeError('slot %s requires markup, not %s' % (self.name, type(value).__name__))
+
+class Template(object):
+    """
+    Page template compiled from an XMLDocument or XMLElement with Slot placeholders in its content.
+    The static parts are serialized once into utf-8 encoded fragments, rendering a page only serializes the values
+    of the slots and joins them with the fragments. Templates are meant to be created once, e.g. at module level.
+    """
+    
+    def __init__(self, source, lf=False):
+        self.lf = lf
+        self.fragments = []
+        static = []
+        for chunk in source.chunks(lf=lf):
+            if isinstance(chunk, Slot):
+                self.fragments.append(u''.join(static).encode('utf-8'))
+                self.fragments.append(chunk)
+                static = []
+            else:
+                static.append(chunk)
+        self.fragments.append(u''.join(static).encode('utf-8'))
+        self.slots = dict((fragment.name, fragment) for fragment in self.fragments if isinstance(fragment, Slot))
+    
+    def render(self, **values):
+        """
+        Provides the page as a utf-8 encoded string, slots without a value are left empty
+        """
+        return ''.join(self.parts(values))
+    
+    def render_to(self, out, **values):
+        """
+        Writes the page into a file-like object, e.g. a webapp2 response.out
+        """
+        for part in self.parts(values):
+            out.write(part)
+    
+    def parts(self, values):
+        for name in values:
+            if name not in self.slots:
+                raise KeyError('template has no slot %s' % name)
+        for fragment in self.fragments:
+            if isinstance(fragment, Slot):
+                yield fragment.render(values.get(fragment.name), lf=self.lf).encode('utf-8')
+            else:
+                yield fragment
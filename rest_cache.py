@@ -0,0 +1,248 @@
+# coding=utf-8
+#
+#  Copyright (c) 2014-2015 First Flamingo Enterprise B.V.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  rest_cache.py
+#  firstflamingo/python_utilities
+#
+
+import threading
+import time
+from collections import OrderedDict
+
+from google.appengine.api import memcache
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import ndb
+from ffe_utils import etag_for_content, etag_for_encoding, encoded_content
+
+MAX_MEMCACHE_SIZE = 1000000
+
+
+# ====== In-process cache ==============================================================================================
+
+
+class LRUCache(object):
+    """
+    In-process least recently used cache, bounded by the total size in bytes of its values.
+    Entries can be given a time to live in seconds. The cache can be shared by the threads of an instance.
+    """
+
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[2] is not None and entry[2] < time.time():
+                self.size -= entry[1]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries[key] = entry  # re-inserted as most recently used
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, size):
+        if size > self.max_size:
+            return
+        expires = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            old_entry = self._entries.pop(key, None)
+            if old_entry is not None:
+                self.size -= old_entry[1]
+            self._entries[key] = (value, size, expires)
+            self.size += size
+            while self.size > self.max_size:
+                evicted_key, evicted_entry = self._entries.popitem(last=False)
+                self.size -= evicted_entry[1]
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        return {'entries': len(self._entries), 'size': self.size,
+                'hits': self.hits, 'misses': self.misses, 'hit_rate': hit_rate(self.hits, self.misses)}
+
+
+def hit_rate(hits, misses):
+    if hits + misses == 0:
+        return 0.0
+    return float(hits) / (hits + misses)
+
+
+# ====== Resource cache ================================================================================================
+
+
+class ResourceCache(object):
+    """
+    Two-tier read-through cache for resources.
+    1) entities
+       are cached in-process as protocol buffers, in front of the ndb get (which uses memcache itself).
+       Entities are invalidated on put and delete, changes made by other instances are picked up after entity_ttl.
+       So this tier is for public reads only, reads that lead to a write or to authentication must bypass it.
+    2) serializations
+       are cached in-process and in memcache together with their entity tag,
+       keyed by class, id, version (the last modification) and data type.
+       A modified resource has a new key, so a stale serialization will never be found.
+    """
+
+    def __init__(self, entity_size=4000000, serialization_size=16000000, entity_ttl=10):
+        self.entities = LRUCache(entity_size, ttl=entity_ttl)
+        self.serializations = LRUCache(serialization_size)
+        self.memcache_hits = 0
+        self.memcache_misses = 0
+
+    # ------------ Caching entities ------------------------------------------------------------------------------------
+
+    @staticmethod
+    def entity_key(resource_class, identifier):
+        return resource_class.__name__, identifier
+
+    def get_entity(self, resource_class, identifier):
+        """
+        Provides the entity of resource_class with the specified identifier, or None if it does not exist.
+        Every call provides a fresh instance, changes to it will not affect the cache.
+        """
+        key = self.entity_key(resource_class, identifier)
+        encoded = self.entities.get(key)
+        if encoded is not None:
+            return ndb.model_from_protobuf(entity_pb.EntityProto(encoded))
+        entity = resource_class.get_by_id(identifier)
+        if entity is not None:
+            self.set_entity(entity)
+        return entity
+
+    @ndb.tasklet
+    def get_entity_async(self, resource_class, identifier):
+        """
+        Asynchronous version of get_entity(), the datastore is only called when the entity is not cached
+        """
+        encoded = self.entities.get(self.entity_key(resource_class, identifier))
+        if encoded is not None:
+            raise ndb.Return(ndb.model_from_protobuf(entity_pb.EntityProto(encoded)))
+        entity = yield resource_class.get_by_id_async(identifier)
+        if entity is not None:
+            self.set_entity(entity)
+        raise ndb.Return(entity)
+
+    def get_entities(self, resource_class, identifiers):
+        """
+        Provides the entities of resource_class with the specified identifiers, in the same order.
+        Entities not found in the cache are fetched with a single get_multi, None is provided for missing entities.
+        """
+        entities = [None] * len(identifiers)
+        uncached = []
+        for index, identifier in enumerate(identifiers):
+            encoded = self.entities.get(self.entity_key(resource_class, identifier))
+            if encoded is not None:
+                entities[index] = ndb.model_from_protobuf(entity_pb.EntityProto(encoded))
+            else:
+                uncached.append(index)
+        if uncached:
+            fetched = ndb.get_multi([ndb.Key(resource_class, identifiers[index]) for index in uncached])
+            for index, entity in zip(uncached, fetched):
+                if entity is not None:
+                    self.set_entity(entity)
+                    entities[index] = entity
+        return entities
+
+    def set_entity(self, entity):
+        encoded = ndb.model_to_protobuf(entity).Encode()
+        self.entities.set(self.entity_key(entity.__class__, entity.key.id()), encoded, len(encoded))
+
+    def invalidate(self, resource_class, identifier):
+        self.entities.delete(self.entity_key(resource_class, identifier))
+
+    # ------------ Caching serializations ------------------------------------------------------------------------------
+
+    @staticmethod
+    def serialization_key(resource, data_type, encoding=None):
+        version = resource.version
+        if resource.key is None or version is None:
+            return None
+        key = 'ser:%s:%s:%s:%d' % (resource.__class__.__name__, resource.key.id(), version.isoformat(), data_type)
+        if encoding:
+            key = '%s:%s' % (key, encoding)
+        return key
+
+    def representation(self, resource, data_type, serializer, encoding=None):
+        """
+        Provides the serialization of resource in data_type together with its entity tag, from the cache if available.
+        Serializations compressed with a content encoding are cached next to the uncompressed serialization.
+        :param serializer: function without arguments, providing the serialization when it is not cached
+        :param encoding: content encoding, one of ffe_utils.CONTENT_ENCODINGS or None
+        :return: tuple (serialization, etag), (None, None) if the resource has no serialization in data_type
+        """
+        if encoding is None:
+            create = lambda: self.new_representation(serializer)
+        else:
+            create = lambda: self.encoded_representation(self.representation(resource, data_type, serializer), encoding)
+        key = self.serialization_key(resource, data_type, encoding)
+        if key is None:
+            return create()
+        value = self.serializations.get(key)
+        if value is None:
+            value = memcache.get(key)
+            if value is None:
+                self.memcache_misses += 1
+                value = create()
+                if value[0] is None:
+                    return value
+                if len(value[0]) < MAX_MEMCACHE_SIZE:
+                    memcache.set(key, value)
+            else:
+                self.memcache_hits += 1
+            self.serializations.set(key, value, len(value[0]) + len(value[1]))
+        return value
+
+    @staticmethod
+    def new_representation(serializer):
+        serialization = serializer()
+        if serialization is None:
+            return None, None
+        return serialization, etag_for_content(serialization)
+
+    @staticmethod
+    def encoded_representation(representation, encoding):
+        serialization, etag = representation
+        if serialization is None:
+            return None, None
+        return encoded_content(serialization, encoding), etag_for_encoding(etag, encoding)
+
+    # ------------ Statistics ------------------------------------------------------------------------------------------
+
+    def stats(self):
+        return {'entities': self.entities.stats(),
+                'serializations': self.serializations.stats(),
+                'memcache': {'hits': self.memcache_hits, 'misses': self.memcache_misses,
+                             'hit_rate': hit_rate(self.memcache_hits, self.memcache_misses)}}
+
+
+resource_cache = ResourceCache()
@@ -21,13 +21,19 @@
 #
 
 import logging
+import math
 import random
 from datetime import timedelta
 
 import webapp2
-from ffe_time import now_utc, utc_from_rfc1123
-from ffe_utils import md5_hash, paramslist_from_dict, dict_from_paramslist
-from rest_resources import DataType, Catalog, NoValidIdentifierError, InvalidUpdateDataError
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
+from ffe_time import now_utc, utc_from_rfc1123, utc_from_string
+from ffe_utils import md5_hash, paramslist_from_dict, dict_from_paramslist, etag_matches, accepted_encoding
+import rest_negotiation
+from rest_throttle import rate_limiter
+from rest_resources import DataType, Catalog, ResourceBatch, UnitOfWork
+from rest_resources import NoValidIdentifierError, InvalidUpdateDataError, BatchTooLargeError
 
 
 class ResourceHandler(webapp2.RequestHandler):
@@ -37,18 +43,67 @@ class ResourceHandler(webapp2.RequestHandler):
     Class and instance are deduced from the url, following the pattern:
     http://host.com/api/class/identifier
 
-    When implementing a ResourceHandler, a resource_class must be set.
+    When implementing a ResourceHandler, either a resource_class must be set, or multiple resource classes must be
+    registered with register(). Registered classes are found by their url_name with a dictionary lookup,
+    a url_name may contain slashes for nested paths: http://host.com/api/area/class/identifier
 
     To be handled by ResourceHandler, a resource must implement:
        - get(identifier): class method, fetches instance with specified identifier
        - valid_identifier(identifier): class method, returning a validated identifier or raising NoValidIdentifierError
     """
     resource_class = None
+    routes = None
+    route_depths = ()
     _valid_class_url = None
     _valid_resource_id = None
     _resource_id = None
     _resource = None
 
+    # ------------ Routing ---------------------------------------------------------------------------------------------
+
+    @classmethod
+    def register(cls, *resource_classes):
+        """
+        Registers resource classes to be handled by this handler class, routed by their url_name
+        """
+        if 'routes' not in cls.__dict__:
+            cls.routes = {}
+        for resource_class in resource_classes:
+            cls.routes[resource_class.url_name] = resource_class
+        cls.route_depths = sorted(set(url_name.count('/') + 1 for url_name in cls.routes), reverse=True)
+
+    def dispatch(self):
+        if self.routes is not None:
+            self.parse_request_path()
+            if self.resource_class is None:
+                self.error(404)  # Not Found
+                return
+        if not self.admit():
+            return
+        super(ResourceHandler, self).dispatch()
+
+    def admit(self):
+        """
+        Admission control, called before the request is handled. Subclasses can refuse requests by returning False,
+        after setting the response.
+        """
+        return True
+
+    def route(self, comps):
+        """
+        Finds the resource class for the components of the request path
+        :return: tuple (resource class or None, number of path components in its url_name)
+        """
+        if self.routes is None:
+            if comps[2] == self.resource_class.url_name:
+                return self.resource_class, 1
+            return None, 0
+        for depth in self.route_depths:
+            resource_class = self.routes.get('/'.join(comps[2:2 + depth]))
+            if resource_class is not None:
+                return resource_class, depth
+        return None, 0
+
     # ------------ Translating URL-path into a resource ----------------------------------------------------------------
 
     @property
@@ -84,18 +139,26 @@ class ResourceHandler(webapp2.RequestHandler):
         comps = self.request.path.split('/')
         if len(comps) < 3:
             return
-        if comps[2] != self.resource_class.url_name:
+        resource_class, depth = self.route(comps)
+        if resource_class is None:
             return
-        if len(comps) == 3:
+        self.resource_class = resource_class
+        comps = comps[2 + depth:]
+        if len(comps) == 0:
             self._valid_class_url = True
             return
-        if len(comps) == 4:
-            identifier = comps[3]
-            try:
-                self._resource_id = self.resource_class.valid_identifier(identifier)
-                self._valid_resource_id = True
-            except NoValidIdentifierError:
-                self._valid_resource_id = False
+        if len(comps) == 1:
+            self._valid_resource_id, self._resource_id = self.validated_identifier(comps[0])
+
+    def validated_identifier(self, identifier):
+        """
+        Validates an identifier for the resource class
+        :return: tuple (is valid, validated identifier)
+        """
+        try:
+            return True, self.resource_class.valid_identifier(identifier)
+        except NoValidIdentifierError:
+            return False, None
 
     # ------------ Debugging -------------------------------------------------------------------------------------------
 
@@ -125,16 +188,30 @@ class RestHandler(ResourceHandler):
     It handles two kinds of resources:
     1) public resources
        public resources have fixed indexes, can be read by everyone and modified by admins only
+       a GET on the class url provides the catalog, or only the changes since the 'since' parameter
     2) user resources ("non-publications")
        these resources have server generated indexes, they can be read and modified by their specified owner only
+    A GET on the class url with an 'ids' parameter (comma separated identifiers) provides multiple resources at once,
+    with an 'export' parameter it provides all resources of the class as newline delimited json, in resumable chunks.
+    A POST (user resources) or PUT (all resources) on the class url with a json array creates or updates multiple
+    resources at once, stored with put_multi and followed by a single catalog invalidation. Batches require
+    authentication and hold at most max_batch_size objects.
+    Clients exceeding the rate limit of the resource class are refused with 429 Too Many Requests and a Retry-After.
 
     To be handled by RestHandler, a resource must implement:
     1) Configuration properties
        - is_publication: indicates whether the class is a publication or a user resource
+       - rate_limit: tuple (burst capacity, requests per second) limiting requests per client address and per user,
+         None for no limit
+       - catalog_rate_limit: idem for GET requests on the class url of a publication
     2) Object lifecycle
        - new(identifier): class method, creates a new instance
        - get(identifier): class method, fetches instance with specified identifier
+       - get_async(identifier, cached): class method, ndb tasklet fetching instance with specified identifier,
+         cached=True allows a possibly outdated copy from an in-process cache (used for public reads only)
        - put(): instance method, stores the instance
+       - save(): instance method, stores the instance or registers it with the active UnitOfWork
+       - put_multi(instances): class method, stores multiple instances
        - delete(): instance method, removes the instance
     3) Object metadata
        - valid_identifier(identifier): class method, returning a validated identifier or raising NoValidIdentifierError
@@ -144,15 +221,66 @@ class RestHandler(ResourceHandler):
     4) Access to the content
        - readable_data_types(): class method, returning a list of DataTypes the resource can read
        - update_with_string(string, data_type): updates the instance with a string following the indicated data type
+       - new_multi(string, data_type, max_size), update_multi(string, data_type, create, max_size): class methods,
+         returning multiple new or updated instances, or raising InvalidUpdateDataError, or BatchTooLargeError for
+         arrays of more than max_size objects
        - writable_data_types(): class method, returning a list of DataTypes the resource can write
-       - serialization_of_type(data_type): returns a string with the instances content in the requested data type
+       - serialization_of_type(data_type, encoding): returns a string with the instances content in the requested
+         data type, compressed with the content encoding ('gzip', 'deflate' or None)
+       - etag_of_type(data_type, encoding): returns the entity tag of that serialization, or None
     """
     user_class = None
     user = None
     allows_anonymous_post = False
+    max_batch_size = 1000
+    max_export_size = 10000
+    unit_of_work = None
+    retry_after = None
 
     # ------------ Handling http requests ------------------------------------------------------------------------------
 
+    def dispatch(self):
+        """
+        Handles the request within a UnitOfWork, changed resources are stored once, before output is written
+        or when the request is finished
+        """
+        self.unit_of_work = UnitOfWork()
+        with self.unit_of_work:
+            super(RestHandler, self).dispatch()
+
+    def flush(self):
+        if self.unit_of_work is not None:
+            self.unit_of_work.flush()
+
+    # ------------ Admission control -----------------------------------------------------------------------------------
+
+    def admit(self):
+        """
+        Refuses the request with 429 when the client address exceeds the rate limit of the resource class.
+        Authenticated users are also limited by username, in authenticate_async()
+        """
+        scope, limit = self.rate_limit_scope()
+        wait = rate_limiter.check(scope, self.request.remote_addr, limit)
+        if wait:
+            self.too_many_requests(wait)
+            return False
+        return True
+
+    def rate_limit_scope(self):
+        """
+        Provides the scope and limit for the request: GET requests on the class url of a publication (catalogs,
+        batches and exports) use catalog_rate_limit of the resource class, other requests use rate_limit
+        :return: tuple (scope, limit)
+        """
+        name = self.resource_class.__name__
+        if self.request.method == 'GET' and self.resource_class.is_publication and self.valid_class_url:
+            return '%s.catalog' % name, self.resource_class.catalog_rate_limit
+        return name, self.resource_class.rate_limit
+
+    def too_many_requests(self, wait):
+        self.response.set_status(429, 'Too Many Requests')
+        self.response.headers['Retry-After'] = str(int(math.ceil(wait)))
+
     def post(self):
         """
         Handles http POST request
@@ -174,6 +302,10 @@ class RestHandler(ResourceHandler):
             self.error(415)  # Unsupported Media Type
             return
 
+        if self.has_batch_body(data_type):
+            self.post_batch(data_type)
+            return
+
         self.resource = self.resource_class.new()
         try:
             self.resource.update_with_string(self.request.body, data_type)
@@ -185,33 +317,79 @@ class RestHandler(ResourceHandler):
             self.resource.owner_key = self.user.key
         if hasattr(self.resource, 'creation_address'):
             self.resource.creation_address = self.request.remote_addr
-        self.resource.put()
+        self.resource.save()
+        self.flush()
         self.response.headers.add('Location', self.resource.url)
         logging.info('Created: %s' % self.resource)
         self.write_output(self.resource, data_type)
         self.response.status_int = 201  # Created
 
+    def post_batch(self, data_type):
+        """
+        Handles a POST request with an array of objects, creating all resources or none.
+        Batches require authentication, also when allows_anonymous_post is set.
+        """
+        if self.user is None and not self.authenticate():
+            self.require_authentication()
+            return
+
+        try:
+            resources = self.resource_class.new_multi(self.request.body, data_type, max_size=self.max_batch_size)
+        except BatchTooLargeError:
+            self.error(400)  # Bad Request
+            return
+        except InvalidUpdateDataError:
+            self.error(422)  # Unprocessable Entity
+            return
+
+        for resource in resources:
+            if self.user and hasattr(resource, 'owner_key'):
+                resource.owner_key = self.user.key
+            if hasattr(resource, 'creation_address'):
+                resource.creation_address = self.request.remote_addr
+        self.resource_class.put_multi(resources)
+        logging.info('Created %d %s objects' % (len(resources), self.resource_class.__name__))
+        self.write_output(ResourceBatch(resources), data_type)
+        self.response.status_int = 201  # Created
+
     def get(self):
         """
         Handles http GET request
         """
-        if not (self.resource_class.is_publication or self.authenticate()):
+        authentication = None
+        if not self.resource_class.is_publication:
+            authentication = self.authenticate_async()
+        fetch = self.fetch_resource_async()
+        if authentication is not None and not authentication.get_result():
             self.require_authentication()
             return
 
-        resource = None
+        identifiers = self.request.get('ids')
+        if identifiers and self.valid_class_url:
+            self.get_batch(identifiers.split(','))
+            return
+
+        if self.is_export_request:
+            self.get_export()
+            return
+
         resource_class = None
+        since = None
         if self.valid_class_url:
             if not self.resource_class.is_publication:
                 self.error(405)  # Method Not Allowed
                 return
             resource_class = Catalog
-            resource = resource_class.get(self.resource_class)
+            try:
+                since = self.catalog_since()
+            except ValueError:
+                self.error(400)  # Bad Request
+                return
 
         if self.valid_resource_id:
-            resource = self.resource
             resource_class = self.resource_class
 
+        resource = fetch.get_result()
         if not resource:
             self.error(404)  # Not Found
             return
@@ -220,19 +398,123 @@ class RestHandler(ResourceHandler):
             self.error(401)  # Unauthorized
             return
 
-        modified_since = self.request.headers.get('If-Modified-Since')
-        if modified_since and resource.last_modified_utc <= utc_from_rfc1123(modified_since):
+        data_type = self.output_data_type(resource_class)
+        if data_type is None:
+            self.error(406)  # Not Acceptable
+            return
+
+        if self.is_not_modified(resource, data_type):
             logging.info('Not Modified: %s' % resource)
             self.response.content_type = None
             self.response.status_int = 304  # Not Modified
             return
 
-        data_type = self.output_data_type(resource_class)
-        if data_type is None:
+        if since is not None:
+            resource = resource.changes_since(since)
+
+        self.write_output(resource, data_type)
+
+    @ndb.tasklet
+    def fetch_resource_async(self):
+        """
+        Fetches the resource addressed by the url: the catalog for the class url of a publication,
+        or the identified resource. Runs concurrently with authenticate_async()
+        """
+        resource = None
+        if self.valid_class_url:
+            if self.resource_class.is_publication and not (self.request.get('ids') or self.is_export_request):
+                resource = yield Catalog.get_async(self.resource_class)
+        elif self.valid_resource_id:
+            resource = yield self.resource_class.get_async(self.resource_id, cached=self.resource_class.is_publication)
+            self.resource = resource
+        raise ndb.Return(resource)
+
+    def get_batch(self, identifiers):
+        """
+        Handles a GET request for multiple resources, provided as one document by ResourceBatch.
+        All resources are fetched with a single get_multi, resources that are not found or that the user
+        is not authorized for are listed as missing.
+        """
+        if len(identifiers) > self.max_batch_size:
+            self.error(400)  # Bad Request
+            return
+
+        data_type = self.output_data_type(self.resource_class)
+        if DataType.codec(data_type) is None:
             self.error(406)  # Not Acceptable
             return
 
-        self.write_output(resource, data_type)
+        found = []
+        missing = []
+        resources = self.resource_class.get_multi(identifiers, cached=self.resource_class.is_publication)
+        for identifier, resource in zip(identifiers, resources):
+            if resource and (self.resource_class.is_publication or self.is_authorized(resource)):
+                found.append(resource)
+            else:
+                missing.append(identifier)
+        batch = ResourceBatch(found, missing)
+
+        if self.is_not_modified(batch, data_type, use_modified_since=False):
+            logging.info('Not Modified: %s' % batch)
+            self.response.content_type = None
+            self.response.status_int = 304  # Not Modified
+            return
+
+        self.write_output(batch, data_type)
+
+    @property
+    def is_export_request(self):
+        return self.valid_class_url and 'export' in self.request.GET
+
+    def get_export(self):
+        """
+        Handles a GET request for an export of the resource class, as newline delimited json.
+        An export response contains at most max_export_size resources, or the number in the 'limit' parameter.
+        When the export is not complete, the X-Export-Cursor header provides the value of the 'cursor' parameter
+        for the next request. Users that are not admin can only export their own user resources.
+        """
+        try:
+            limit = min(int(self.request.get('limit', self.max_export_size)), self.max_export_size)
+        except ValueError:
+            self.error(400)  # Bad Request
+            return
+        if limit < 1:
+            self.error(400)  # Bad Request
+            return
+
+        query = self.resource_class.query()
+        if not (self.resource_class.is_publication or self.user.has_admin_privileges):
+            if not hasattr(self.resource_class, 'owner_key'):
+                self.error(401)  # Unauthorized
+                return
+            query = query.filter(self.resource_class.owner_key == self.user.key)
+
+        self.response.content_type = 'application/x-ndjson'
+        try:
+            count, cursor = self.resource_class.export_ndjson(self.response.out, cursor=self.request.get('cursor'),
+                                                              limit=limit, query=query)
+        except (datastore_errors.BadValueError, datastore_errors.BadRequestError):
+            self.response.clear()
+            self.error(400)  # Bad Request: invalid cursor
+            return
+        logging.info('Exported %d %s objects' % (count, self.resource_class.__name__))
+        if cursor:
+            self.response.headers.add('X-Export-Cursor', cursor)
+
+    def is_not_modified(self, resource, data_type, use_modified_since=True):
+        """
+        Evaluates the conditional GET headers, If-None-Match takes precedence over If-Modified-Since.
+        The entity tag is taken from the cached representation, no serialization is needed when it is cached.
+        :param use_modified_since: False to ignore If-Modified-Since, for documents whose last modification does
+                                   not cover all of their content (e.g. the missing items of a ResourceBatch)
+        """
+        none_match = self.request.headers.get('If-None-Match')
+        if none_match:
+            return etag_matches(none_match, resource.etag_of_type(data_type, self.output_encoding))
+        modified_since = self.request.headers.get('If-Modified-Since')
+        if modified_since and use_modified_since:
+            return resource.last_modified_utc <= utc_from_rfc1123(modified_since)
+        return False
 
     def put(self):
         """
@@ -247,18 +529,28 @@ class RestHandler(ResourceHandler):
             self.error(415)  # Unsupported Media Type
             return
 
+        if self.valid_class_url and self.has_batch_body(data_type):
+            self.put_batch(data_type)
+            return
+
         if self.resource:
             if not self.resource_is_authorized:
                 logging.info('Resource is not authorized')
                 self.error(401)  # Unauthorized
                 return
 
+            if_match = self.request.headers.get('If-Match')
             unmodified_since = self.request.headers.get('If-Unmodified-Since')
-            if not unmodified_since:
+            if if_match:
+                precondition = etag_matches(if_match, self.resource.etag_of_type(data_type), weak=False,
+                                            any_encoding=True)
+            elif unmodified_since:
+                precondition = self.resource.last_modified_utc <= utc_from_rfc1123(unmodified_since)
+            else:
                 self.error(409)  # Conflict
                 return
 
-            if self.resource.last_modified_utc <= utc_from_rfc1123(unmodified_since):
+            if precondition:
                 self.resource.update_with_string(self.request.body, data_type)
                 self.write_output(self.resource, data_type)
             else:
@@ -283,6 +575,46 @@ class RestHandler(ResourceHandler):
             else:
                 self.error(404)  # Not Found
 
+    def put_batch(self, data_type):
+        """
+        Handles a PUT request on the class url with an array of objects, updating all resources or none.
+        Objects are identified by their 'id', admins can create publications with new ids.
+        If-Unmodified-Since is required and applies to all existing resources.
+        """
+        unmodified_since = self.request.headers.get('If-Unmodified-Since')
+        if not unmodified_since:
+            self.error(409)  # Conflict
+            return
+
+        create = self.resource_class.is_publication and self.user.has_admin_privileges
+        try:
+            resources = self.resource_class.update_multi(self.request.body, data_type, create=create,
+                                                         max_size=self.max_batch_size)
+        except BatchTooLargeError:
+            self.error(400)  # Bad Request
+            return
+        except InvalidUpdateDataError:
+            self.error(422)  # Unprocessable Entity
+            return
+
+        unmodified_since = utc_from_rfc1123(unmodified_since)
+        for resource in resources:
+            if not self.is_authorized(resource):
+                logging.info('Resource is not authorized: %s' % resource.id_)
+                self.error(401)  # Unauthorized
+                return
+            if resource.last_modified is not None and resource.last_modified_utc > unmodified_since:
+                self.error(412)  # Precondition Failed
+                return
+
+        self.resource_class.put_multi(resources)
+        logging.info('Updated %d %s objects' % (len(resources), self.resource_class.__name__))
+        self.write_output(ResourceBatch(resources), data_type)
+
+    def has_batch_body(self, data_type):
+        codec = DataType.codec(data_type)
+        return codec is not None and codec.is_list(self.request.body)
+
     def delete(self):
         """
         Handles http DELETE request
@@ -302,25 +634,46 @@ class RestHandler(ResourceHandler):
         else:
             self.error(404)  # Not Found
 
+    def catalog_since(self):
+        """
+        Provides the moment since which a client wants to receive catalog changes, or None for the full catalog.
+        The moment is taken from the 'since' parameter (yyyy-mm-ddThh:mm:ss, UTC). If-Modified-Since is not used
+        for this, a cache revalidating the full catalog must not receive only the changes.
+        Raises ValueError when the moment can not be parsed.
+        """
+        since = self.request.get('since')
+        if since:
+            return utc_from_string(since)
+
     # ------------ Handling authentication  ----------------------------------------------------------------------------
 
     @property
     def resource_is_authorized(self):
+        return self.is_authorized(self.resource)
+
+    def is_authorized(self, resource):
         if self.user is None:
             return False
         if self.user.has_admin_privileges:
             logging.info('user has admin privileges')
             return True
-        if hasattr(self.resource, 'owner_key') and self.resource.owner_key == self.user.key:
+        if hasattr(resource, 'owner_key') and resource.owner_key == self.user.key:
             logging.info('user is owner')
             return True
         return False
 
     def authenticate(self):
+        return self.authenticate_async().get_result()
+
+    @ndb.tasklet
+    def authenticate_async(self):
+        """
+        Validates the Digest Authorization header, the only datastore call (fetching the user) is asynchronous
+        """
         auth_header = self.request.headers.get('Authorization')
         if not auth_header:
             logging.info('No Authorization header')
-            return False
+            raise ndb.Return(False)
 
         params = dict_from_paramslist(auth_header)
         try:
@@ -335,11 +688,11 @@ class RestHandler(ResourceHandler):
             response = params['response']
         except KeyError:
             logging.info('Missing keys in Authorization header: %s' % auth_header)
-            return False
+            raise ndb.Return(False)
 
         if realm != self.user_class.realm:
             logging.info('Stated realm %s does not match %s' % (realm, self.user_class.realm))
-            return False
+            raise ndb.Return(False)
 
         now = now_utc()
         ref_opaque = self.opaque_from_nonce(nonce, now)
@@ -348,32 +701,40 @@ class RestHandler(ResourceHandler):
             ref_opaque = self.opaque_from_nonce(nonce, now)
             if opaque != ref_opaque:
                 logging.info('Nonce has expired')
-                return False
+                raise ndb.Return(False)
+
+        if uri != self.request.path:
+            logging.info('URI \"%s\" does not match path \"%s\"' % (uri, self.request.path))
+            raise ndb.Return(False)
 
         self.user = None
         try:
-            self.user = self.user_class.get(username)
+            self.user = yield self.user_class.get_async(username)
         except NoValidIdentifierError:
             logging.info('Not a valid username: %s' % username)
-            return False
+            raise ndb.Return(False)
         if not self.user:
             logging.info('No user with username %s' % username)
-            return False
+            raise ndb.Return(False)
 
-        if uri != self.request.path:
-            logging.info('URI \"%s\" does not match path \"%s\"' % (uri, self.request.path))
-            return False
         ha2 = md5_hash([self.request.method, uri])
-
         ref_response = md5_hash([self.user.ha1, nonce, nc, cnonce, qop, ha2])
         if response != ref_response:
             logging.info('Authentication for user %s denied' % self.user.label)
-            return False
+            raise ndb.Return(False)
+
+        scope, limit = self.rate_limit_scope()
+        self.retry_after = rate_limiter.check(scope, 'user:%s' % username, limit)
+        if self.retry_after:
+            raise ndb.Return(False)
 
         logging.info('Authenticated user %s' % self.user.label)
-        return True
+        raise ndb.Return(True)
 
     def require_authentication(self):
+        if self.retry_after:
+            self.too_many_requests(self.retry_after)
+            return
         random.seed()
         nonce = str(random.randint(0, 999999))
         params = {'realm': self.user_class.realm, 'qop': 'auth', 'nonce': nonce,
@@ -391,30 +752,26 @@ class RestHandler(ResourceHandler):
 
     @property
     def input_data_type(self):
-        type_string = self.request.headers.get('Content-Type')
-        if type_string is not None:
-            components = type_string.split(';')
-            data_type = DataType.type_for_string(components[0])
-            if data_type in self.resource_class.readable_data_types():
-                return data_type
+        return rest_negotiation.input_data_type(self.request.headers.get('Content-Type'), self.resource_class)
 
     def output_data_type(self, target_class):
-        accept_string = self.request.headers.get('Accept')
-        acceptable_types = []
-        if accept_string is not None:
-            accept_list = accept_string.split(',')
-            for accept in accept_list:
-                components = accept.split(';')
-                data_type = DataType.type_for_string(components[0])
-                if data_type is not None:
-                    acceptable_types.append(data_type)
-            for data_type in acceptable_types:
-                if data_type in target_class.writable_data_types():
-                    return data_type
+        return rest_negotiation.output_data_type(self.request.headers.get('Accept'), target_class)
+
+    @property
+    def output_encoding(self):
+        return accepted_encoding(self.request.headers.get('Accept-Encoding'))
 
     def write_output(self, resource, data_type):
+        self.flush()
         logging.info('Send: %s' % resource)
+        encoding = self.output_encoding
         self.response.content_type = DataType.s[data_type]
         self.response.headers.add('Last-Modified', resource.last_modified_http)
-        self.response.out.write(resource.serialization_of_type(data_type))
+        self.response.headers.add('Vary', 'Accept, Accept-Encoding')
+        etag = resource.etag_of_type(data_type, encoding)
+        if etag:
+            self.response.headers.add('ETag', etag)
+        if encoding:
+            self.response.headers.add('Content-Encoding', encoding)
+        self.response.out.write(resource.serialization_of_type(data_type, encoding))
 
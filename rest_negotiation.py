@@ -0,0 +1,142 @@
+# coding=utf-8
+#
+#  Copyright (c) 2014-2015 First Flamingo Enterprise B.V.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  rest_negotiation.py
+#  firstflamingo/python_utilities
+#
+
+from rest_resources import DataType
+
+MAX_CACHED_HEADER = 512
+MAX_DECISIONS = 10000
+decisions = {}
+
+
+# ====== Content negotiation ===========================================================================================
+
+
+def output_data_type(accept_string, target_class):
+    """
+    Provides the DataType to write target_class in, according to an Accept header, or None if none is acceptable.
+    Media ranges with wildcards and q-values are supported, decisions are cached per Accept header and class.
+    """
+    if accept_string is None:
+        return None
+    key = ('output', accept_string, target_class)
+    try:
+        return decisions[key]
+    except KeyError:
+        data_type = best_data_type(parse_media_ranges(accept_string), target_class.writable_data_types())
+        remember(key, data_type, accept_string)
+        return data_type
+
+
+def input_data_type(type_string, target_class):
+    """
+    Provides the DataType of a Content-Type header, if target_class can read it, otherwise None.
+    Decisions are cached per Content-Type header and class.
+    """
+    if type_string is None:
+        return None
+    key = ('input', type_string, target_class)
+    try:
+        return decisions[key]
+    except KeyError:
+        data_type = DataType.type_for_string(type_string.split(';')[0].strip().lower())
+        if data_type not in target_class.readable_data_types():
+            data_type = None
+        remember(key, data_type, type_string)
+        return data_type
+
+
+def remember(key, data_type, header):
+    """
+    Caches a decision in a plain dict, read without a lock. Headers are client controlled: headers longer than
+    MAX_CACHED_HEADER are not cached, and the dict is cleared when it holds MAX_DECISIONS decisions.
+    """
+    if len(header) <= MAX_CACHED_HEADER:
+        if len(decisions) >= MAX_DECISIONS:
+            decisions.clear()
+        decisions[key] = data_type
+
+
+def parse_media_ranges(accept_string):
+    """
+    Parses an Accept header into a list of media ranges
+    :return: list of tuples (media range, q-value), in the order of the header
+    """
+    media_ranges = []
+    for item in accept_string.split(','):
+        components = item.split(';')
+        media_range = components[0].strip().lower()
+        if not media_range:
+            continue
+        if media_range == '*':
+            media_range = '*/*'
+        q = 1.0
+        for parameter in components[1:]:
+            name, _, value = parameter.partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        media_ranges.append((media_range, q))
+    return media_ranges
+
+
+def best_data_type(media_ranges, data_types):
+    """
+    Selects the data type with the highest q-value, each data type gets the q-value of the most specific media range
+    that matches it. Ties are resolved by the order of the media ranges, then by the order of data_types.
+    """
+    best = None
+    best_rank = None
+    for preference, data_type in enumerate(data_types):
+        match = matching_range(media_ranges, DataType.s[data_type])
+        if match is None:
+            continue
+        position, q = match
+        if q <= 0:
+            continue
+        rank = (-q, position, preference)
+        if best_rank is None or rank < best_rank:
+            best = data_type
+            best_rank = rank
+    return best
+
+
+def matching_range(media_ranges, mime_type):
+    """
+    Finds the most specific media range matching mime_type
+    :return: tuple (position of the range, q-value), or None if no range matches
+    """
+    main_type = mime_type.split('/')[0]
+    best = None
+    best_specificity = -1
+    for position, (media_range, q) in enumerate(media_ranges):
+        if media_range == mime_type:
+            specificity = 2
+        elif media_range == main_type + '/*':
+            specificity = 1
+        elif media_range == '*/*':
+            specificity = 0
+        else:
+            continue
+        if specificity > best_specificity:
+            best = (position, q)
+            best_specificity = specificity
+    return best
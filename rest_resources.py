@@ -20,18 +20,32 @@
 #  Created by Berend Schotanus on 18-Apr-2014.
 #
 
-import logging, json, re
-import xml.sax
+import logging, json, re, threading
+from datetime import timedelta
 from google.appengine.ext import ndb
 from google.appengine.api import memcache
-from markup import XMLDocument
-from ffe_utils import md5_hash
-from ffe_time import mark_utc, rfc1123_from_utc
+from markup import XMLDocument, parse_xml
+from ffe_utils import md5_hash, encoded_content, etag_for_content, etag_for_encoding
+from ffe_time import mark_utc, now_utc, rfc1123_from_utc, string_from_utc
+from rest_cache import resource_cache
+
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 
 class DataType:
-    xml, json = range(2)
-    s = ['application/xml', 'application/json']
+    """
+    DataType enumerates the data types resources can be read from and written to, identified by their mime type.
+    Structured data types have a codec, translating between dictionaries (or lists) and strings.
+    Additional data types can be added with register(). The msgpack codec is only registered when the msgpack
+    library is available, otherwise application/msgpack is recognized but not readable or writable.
+    """
+    xml, json, msgpack = range(3)
+    s = ['application/xml', 'application/json', 'application/msgpack']
+    codecs = {}
 
     @classmethod
     def type_for_string(cls, string):
@@ -42,6 +56,75 @@ class DataType:
                 break
         return data_type
 
+    @classmethod
+    def register(cls, mime_type, codec=None):
+        """
+        Adds a data type for mime_type, if it is not yet known, and registers its codec
+        :return: the data type
+        """
+        data_type = cls.type_for_string(mime_type)
+        if data_type is None:
+            cls.s.append(mime_type)
+            data_type = len(cls.s) - 1
+        if codec is not None:
+            cls.codecs[data_type] = codec
+        return data_type
+
+    @classmethod
+    def codec(cls, data_type):
+        return cls.codecs.get(data_type)
+
+    @classmethod
+    def structured_types(cls):
+        """
+        Provides the data types with an available codec, json first
+        """
+        return sorted(cls.codecs.keys())
+
+
+class JSONCodec(object):
+
+    @staticmethod
+    def encode(content):
+        return json.dumps(content)
+
+    @staticmethod
+    def decode(string):
+        try:
+            return json.loads(string)
+        except ValueError:
+            raise InvalidUpdateDataError
+
+    @staticmethod
+    def is_list(string):
+        return string.lstrip().startswith('[')
+
+
+class MessagePackCodec(object):
+    unpack_options = {'raw': False}
+
+    @staticmethod
+    def encode(content):
+        return msgpack.packb(content, use_bin_type=False)
+
+    @classmethod
+    def decode(cls, string):
+        try:
+            return msgpack.unpackb(string, **cls.unpack_options)
+        except (msgpack.exceptions.UnpackException, ValueError):
+            raise InvalidUpdateDataError
+
+    @staticmethod
+    def is_list(string):
+        return bool(string) and (0x90 <= ord(string[0]) <= 0x9f or string[0] in '\xdc\xdd')
+
+
+DataType.register(DataType.s[DataType.json], JSONCodec)
+if msgpack is not None:
+    if msgpack.version < (0, 5, 2):
+        MessagePackCodec.unpack_options = {'encoding': 'utf-8'}  # raw=False was added in msgpack 0.5.2
+    DataType.register(DataType.s[DataType.msgpack], MessagePackCodec)
+
 
 class Resource(ndb.Model):
     """
@@ -60,29 +143,148 @@ class Resource(ndb.Model):
     last_modified = ndb.DateTimeProperty(auto_now=True)
     identifier_regex = re.compile('[0-9]{1,19}$')
     is_publication = False
+    rate_limit = None
+    catalog_rate_limit = None
 
     # ------------ Object lifecycle ------------------------------------------------------------------------------------
 
+    batch_size = 500
+    export_batch_size = 500
+    id_block_size = 100
+    _id_pools = {}
+    _is_new = False
+
     @classmethod
     def new(cls, identifier=None):
-        self = cls(id=cls.valid_identifier(identifier))
+        return cls.instantiate(identifier)
+
+    @classmethod
+    def instantiate(cls, identifier=None):
+        """
+        Creates a new instance. Used for creating instances in bulk, subclasses can add side effects to new().
+        """
+        identifier = cls.valid_identifier(identifier)
+        if identifier is None:
+            identifier = cls.allocate_id()
+        self = cls(id=identifier)
+        self._is_new = True
         self.awake_from_create()
-        cls.reset_ids()
         return self
 
     @classmethod
-    def get(cls, identifier=None, create=False):
-        self = cls.get_by_id(cls.valid_identifier(identifier))
+    def allocate_id(cls):
+        """
+        Provides a new numeric id from the IdPool of the class, so new instances have their final key before put
+        """
+        pool = Resource._id_pools.get(cls)
+        if pool is None:
+            pool = Resource._id_pools.setdefault(cls, IdPool(cls, cls.id_block_size))
+        return pool.next_id()
+
+    @classmethod
+    def get(cls, identifier=None, create=False, cached=False):
+        """
+        Fetches the instance with the specified identifier.
+        :param cached: True to read through the in-process cache, which may lag behind changes made by other instances
+                       for up to its ttl. Only for public reads, never for reads that lead to a write or authentication.
+        """
+        identifier = cls.valid_identifier(identifier)
+        if cached:
+            self = resource_cache.get_entity(cls, identifier)
+        else:
+            self = cls.get_by_id(identifier)
         if self:
             self.awake_from_fetch()
         elif create:
             self = cls.new(identifier=identifier)
         return self
 
+    @classmethod
+    @ndb.tasklet
+    def get_async(cls, identifier=None, cached=False):
+        """
+        Asynchronous version of get(), to be yielded from a tasklet
+        """
+        identifier = cls.valid_identifier(identifier)
+        if cached:
+            self = yield resource_cache.get_entity_async(cls, identifier)
+        else:
+            self = yield cls.get_by_id_async(identifier)
+        if self:
+            self.awake_from_fetch()
+        raise ndb.Return(self)
+
+    @classmethod
+    def get_multi(cls, identifiers, cached=False):
+        """
+        Fetches the instances with the specified identifiers with a single get_multi
+        :param cached: True to read through the in-process cache, see get()
+        :return: list in the order of identifiers, with None for invalid identifiers and missing instances
+        """
+        valid_identifiers = []
+        for identifier in identifiers:
+            try:
+                valid_identifiers.append(cls.valid_identifier(identifier))
+            except NoValidIdentifierError:
+                valid_identifiers.append(None)
+        positions = [index for index, identifier in enumerate(valid_identifiers) if identifier is not None]
+        if cached:
+            entities = resource_cache.get_entities(cls, [valid_identifiers[index] for index in positions])
+        else:
+            entities = ndb.get_multi([ndb.Key(cls, valid_identifiers[index]) for index in positions])
+        instances = [None] * len(identifiers)
+        for index, instance in zip(positions, entities):
+            if instance:
+                instance.awake_from_fetch()
+                instances[index] = instance
+        return instances
+
+    def put(self, **ctx_options):
+        """
+        Stores the instance, side effects of storing are performed by put() and put_multi(), so they don't depend on
+        the way an instance was created. The ids are reset when the put stores a new instance.
+        """
+        key = super(Resource, self).put(**ctx_options)
+        if self._is_new:
+            self._is_new = False
+            self.__class__.reset_ids()
+        return key
+
+    def save(self):
+        """
+        Stores the instance, or registers it with the active UnitOfWork, to be stored when the unit is flushed
+        """
+        unit_of_work = UnitOfWork.current()
+        if unit_of_work is None:
+            self.put()
+        else:
+            unit_of_work.register(self)
+
+    @classmethod
+    def put_multi(cls, instances):
+        """
+        Stores instances of the class with put_multi calls of at most batch_size entities.
+        Side effects (resetting the ids, when new instances are stored) are performed once for all instances.
+        """
+        for start in range(0, len(instances), cls.batch_size):
+            ndb.put_multi(instances[start:start + cls.batch_size])
+        new_instances = [instance for instance in instances if instance._is_new]
+        for instance in new_instances:
+            instance._is_new = False
+        if new_instances:
+            cls.reset_ids()
+
     def delete(self):
         self.key.delete()
         self.__class__.reset_ids()
 
+    def _post_put_hook(self, future):
+        resource_cache.invalidate(self.__class__, self.key.id())
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        resource_cache.invalidate(cls, key.id())
+
     def awake_from_create(self):
         pass
 
@@ -99,6 +301,13 @@ class Resource(ndb.Model):
     def last_modified_http(self):
         return rfc1123_from_utc(self.last_modified)
 
+    @property
+    def version(self):
+        """
+        Identifies the state of the resource for caching, None if the resource was not stored yet
+        """
+        return self.last_modified
+
     @classmethod
     def valid_identifier(cls, identifier):
         if identifier is None or not cls.identifier_regex.match(str(identifier)):
@@ -166,27 +375,114 @@ class Resource(ndb.Model):
     def paginated_objects(cls, page=1, length=20):
         return cls.query().fetch(length, offset=(page - 1) * length)
 
+    @classmethod
+    def export_ndjson(cls, out, cursor=None, limit=None, query=None):
+        """
+        Writes dictionary_from_object() of the instances as newline delimited json to out, a file-like object.
+        Instances are fetched in pages of export_batch_size with datastore cursors, so memory use does not depend
+        on the number of instances. An export can be split over multiple requests or tasks by resuming from the
+        returned cursor.
+        :param cursor: websafe cursor string, returned by an earlier export
+        :param limit: maximum number of instances to write, None to write all
+        :param query: the query to export, by default all instances of the class
+        :return: tuple (number of instances written, websafe cursor to resume, None when the export is complete)
+        """
+        if query is None:
+            query = cls.query()
+        start_cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+        count = 0
+        while limit is None or count < limit:
+            page_size = cls.export_batch_size if limit is None else min(cls.export_batch_size, limit - count)
+            instances, start_cursor, more = query.fetch_page(page_size, start_cursor=start_cursor)
+            for instance in instances:
+                instance.awake_from_fetch()
+                out.write(json.dumps(instance.dictionary_from_object()))
+                out.write('\n')
+            count += len(instances)
+            if not more or start_cursor is None:
+                return count, None
+        if start_cursor is None:
+            return count, None
+        return count, start_cursor.urlsafe()
+
     # ------------ Reading content -------------------------------------------------------------------------------------
 
     @classmethod
     def readable_data_types(cls):
-        return [DataType.json]
+        return DataType.structured_types()
 
     @classmethod
     def xml_handler(cls):
         return None
 
     @classmethod
-    def update_multi(cls, update_string, data_type):
+    def update_multi(cls, update_string, data_type, create=False, max_size=None):
+        """
+        Updates multiple instances of the class.
+        For xml the xml_handler reads and stores the data, update_string can also be a file-like object or an
+        iterator of chunks, which are parsed as they are read.
+        For structured data types the string must contain an array of objects with an 'id', the updated instances
+        are returned without being stored, so they can be authorized and stored together with put_multi().
+        All objects are validated before any instance is returned, an invalid object raises InvalidUpdateDataError.
+        :param create: True to create instances for objects with an unknown id, otherwise InvalidUpdateDataError
+        :param max_size: maximum number of objects, a larger array raises BatchTooLargeError before any instance is
+                         fetched or updated
+        """
         if data_type == DataType.xml:
-            xml.sax.parseString(update_string, cls.xml_handler())
+            parse_xml(update_string, cls.xml_handler())
+        elif DataType.codec(data_type) is not None:
+            dictionaries = cls.dictionaries_from_string(update_string, data_type, max_size)
+            identifiers = [dictionary.get('id') for dictionary in dictionaries]
+            if len(set(identifiers)) < len(identifiers):
+                raise InvalidUpdateDataError
+            instances = cls.get_multi(identifiers)
+            for index, dictionary in enumerate(dictionaries):
+                if instances[index] is None:
+                    if not create:
+                        raise InvalidUpdateDataError
+                    try:
+                        instances[index] = cls.instantiate(identifiers[index])
+                    except NoValidIdentifierError:
+                        raise InvalidUpdateDataError
+                instances[index].update_with_dictionary(dictionary)
+            return instances
+
+    @classmethod
+    def new_multi(cls, update_string, data_type, max_size=None):
+        """
+        Creates new instances from an array of objects in a structured data type, without storing them.
+        All objects are validated before any instance is returned, an invalid object raises InvalidUpdateDataError.
+        :param max_size: maximum number of objects, a larger array raises BatchTooLargeError before any id is allocated
+        """
+        instances = []
+        for dictionary in cls.dictionaries_from_string(update_string, data_type, max_size):
+            instance = cls.instantiate()
+            instance.update_with_dictionary(dictionary)
+            instances.append(instance)
+        return instances
+
+    @staticmethod
+    def dictionaries_from_string(update_string, data_type, max_size=None):
+        codec = DataType.codec(data_type)
+        if codec is None:
+            raise InvalidUpdateDataError
+        dictionaries = codec.decode(update_string)
+        if not isinstance(dictionaries, list):
+            raise InvalidUpdateDataError
+        if max_size is not None and len(dictionaries) > max_size:
+            raise BatchTooLargeError
+        for dictionary in dictionaries:
+            if not isinstance(dictionary, dict):
+                raise InvalidUpdateDataError
+        return dictionaries
 
     def update_with_string(self, update_string, data_type):
-        if data_type == DataType.json:
-            if self.update_with_dictionary(json.loads(update_string)):
-                self.put()
+        codec = DataType.codec(data_type)
+        if codec is not None:
+            if self.update_with_dictionary(codec.decode(update_string)):
+                self.save()
         elif data_type == DataType.xml:
-            xml.sax.parseString(update_string, self.__class__.xml_handler())
+            parse_xml(update_string, self.__class__.xml_handler())
 
     def update_with_dictionary(self, dictionary):
         return False
@@ -195,19 +491,37 @@ class Resource(ndb.Model):
 
     @classmethod
     def writable_data_types(cls):
-        return [DataType.json]
+        return DataType.structured_types()
 
-    def serialization_of_type(self, data_type):
-        if data_type == DataType.xml:
+    def serialization_of_type(self, data_type, encoding=None):
+        return self.representation_of_type(data_type, encoding)[0]
+
+    def etag_of_type(self, data_type, encoding=None):
+        return self.representation_of_type(data_type, encoding)[1]
+
+    def representation_of_type(self, data_type, encoding=None):
+        """
+        Provides the serialization in data_type and its entity tag, cached by id and version of the resource
+        :param encoding: optional content encoding to compress the serialization with ('gzip' or 'deflate')
+        :return: tuple (serialization, etag)
+        """
+        return resource_cache.representation(self, data_type, lambda: self.serialize(data_type), encoding)
+
+    def serialize(self, data_type):
+        codec = DataType.codec(data_type)
+        if codec is not None:
+            return codec.encode(self.dictionary_from_object())
+        elif data_type == DataType.xml:
             pass
-        elif data_type == DataType.json:
-            return json.dumps(self.dictionary_from_object())
 
     @classmethod
     def xml_catalog(cls):
+        """
+        Provides an XMLDocument with all instances, fetched in batches while the document is written,
+        e.g. with document.write_to(response.out)
+        """
         document = XMLDocument(cls.__name__)
-        for object in cls.query().fetch(1000):
-            document.root.add(object.xml)
+        document.root.content = (object.xml for object in cls.query().iter(limit=1000, batch_size=cls.batch_size))
         return document
 
     def dictionary_from_object(self):
@@ -215,9 +529,16 @@ class Resource(ndb.Model):
 
 
 class Catalog(Resource):
+    """
+    Catalog publishes the list of all objects of a cataloged class.
+    The entries of the list are divided over a fixed number of CatalogShard entities, by a hash of the resource id.
+    A change to a resource invalidates only the shard holding its entry, invalid shards are rebuilt when read.
+    The shard_count property records the number of shards the catalog was built with.
+    """
     class_module = ndb.TextProperty()
-    catalog = ndb.TextProperty()
+    shard_count = ndb.IntegerProperty(indexed=False)
     identifier_regex = re.compile('[A-Z]\w{1,19}$')
+    _shards = None
 
     # ------------ Object lifecycle ------------------------------------------------------------------------------------
 
@@ -225,6 +546,7 @@ class Catalog(Resource):
     def new(cls, cataloged_class=None):
         self = cls(id=cataloged_class.__name__)
         self.class_module = cataloged_class.__module__
+        self.shard_count = cataloged_class.catalog_shard_count
         self.put()
         return self
 
@@ -235,11 +557,28 @@ class Catalog(Resource):
             self = cls.new(cataloged_class=cataloged_class)
         return self
 
+    @classmethod
+    @ndb.tasklet
+    def get_async(cls, cataloged_class=None, create=True):
+        """
+        Asynchronous version of get(), also fetches the shards of the catalog
+        """
+        self = yield cls.get_by_id_async(cataloged_class.__name__)
+        if self is None and create:
+            self = cls.new(cataloged_class=cataloged_class)
+        if self is not None:
+            yield self.load_shards_async()
+        raise ndb.Return(self)
+
     def invalidate(self):
-        if self.catalog is not None:
+        invalidated = []
+        for shard in self.shards:
+            if shard.entries is not None:
+                shard.invalidate_entries()
+                invalidated.append(shard)
+        if invalidated:
             logging.info('== invalidate catalog ==')
-            self.catalog = None
-            self.put()
+            ndb.put_multi(invalidated)
 
     # ------------ Object metadata -------------------------------------------------------------------------------------
 
@@ -248,43 +587,330 @@ class Catalog(Resource):
         module = __import__(self.class_module)
         return getattr(module, self.id_)
 
+    @property
+    def last_modified_utc(self):
+        return mark_utc(self.catalog_modified.replace(microsecond=0))
+
+    @property
+    def last_modified_http(self):
+        return rfc1123_from_utc(self.catalog_modified)
+
+    @property
+    def version(self):
+        return self.catalog_modified
+
+    @property
+    def catalog_modified(self):
+        """
+        The last modification time of the catalog, which is the latest invalidation of its shards or the last put of
+        the catalog itself. Rebuilding a shard doesn't change it, so the version of the catalog is the same before
+        and after serialize().
+        """
+        dates = [shard.invalidated for shard in self.shards if shard.invalidated is not None]
+        dates.append(self.last_modified)
+        return max(dates)
+
+    @classmethod
+    def writable_data_types(cls):
+        return [DataType.json]
+
+    # ------------ Managing shards -------------------------------------------------------------------------------------
+
+    @property
+    def shards(self):
+        """
+        Provides the shards of the catalog, fetched in a single get_multi.
+        Missing shards are provided as new, invalid shards. When the shard count of the cataloged class has changed,
+        all shards are provided as invalid shards and the new count is recorded.
+        """
+        if self._shards is None:
+            self.load_shards_async().get_result()
+        return self._shards
+
+    @ndb.tasklet
+    def load_shards_async(self):
+        if self._shards is not None:
+            return
+        shard_count = self.cataloged_class.catalog_shard_count
+        keys = [CatalogShard.key_for_index(self.key, index) for index in range(shard_count)]
+        if shard_count == self.shard_count:
+            shards = yield ndb.get_multi_async(keys)
+        else:
+            logging.info('== reshard catalog %s into %d shards ==' % (self.id_, shard_count))
+            self.shard_count = shard_count
+            yield self.put_async()
+            shards = [None] * shard_count
+        self._shards = [shard or CatalogShard(key=key) for shard, key in zip(shards, keys)]
+
+    def rebuild_invalid_shards(self):
+        invalid_shards = dict((index, shard) for index, shard in enumerate(self.shards) if shard.entries is None)
+        if not invalid_shards:
+            return
+        logging.info('== rebuild %d catalog shards ==' % len(invalid_shards))
+        entries = dict((index, []) for index in invalid_shards)
+        query = self.cataloged_class.query().order(-Resource.last_modified)
+        for entry in query.iter(projection=['last_modified']):
+            index = CatalogShard.index_for_identifier(entry.id_, self.shard_count)
+            if index in entries:
+                entries[index].append(json.dumps(self.entry_for_resource(entry)))
+        for index, shard in invalid_shards.iteritems():
+            shard.entries = ', '.join(entries[index])
+        ndb.put_multi(invalid_shards.values())
+
     # ------------ Writing content -------------------------------------------------------------------------------------
 
-    def serialization_of_type(self, data_type):
+    def serialize(self, data_type):
+        """
+        Provides the catalog, joined from the shards. Entries are ordered by last modification within each shard.
+        """
         if data_type == DataType.json:
-            if self.catalog is None:
-                array = []
-                for entry in self.cataloged_class.query().order(-Resource.last_modified).fetch(1000):
-                    array.append({'id': entry.id_, 'lm': entry.last_modified_utc.strftime('%Y-%m-%dT%H:%M:%S')})
-                self.catalog = json.dumps(array)
-                self.put()
-            return self.catalog
+            self.rebuild_invalid_shards()
+            return '[%s]' % ', '.join(shard.entries for shard in self.shards if shard.entries)
+
+    @staticmethod
+    def entry_for_resource(resource):
+        return {'id': resource.id_, 'lm': string_from_utc(resource.last_modified_utc)}
+
+    def changes_since(self, since):
+        """
+        Provides the changes in the catalog since the specified moment, or the full catalog when the moment lies
+        before the retention of tombstones, as deletions before that moment may no longer be known
+        :param since: datetime object with UTC() as timezone
+        :rtype : CatalogDelta
+        """
+        if since < Tombstone.retention_start():
+            return self
+        return CatalogDelta(self, since)
+
+
+class CatalogDelta(object):
+    """
+    CatalogDelta publishes the entries of a catalog that changed since a specified moment.
+    Modified and created resources are listed like in the full catalog, deleted resources are listed with 'del': true.
+    """
+
+    def __init__(self, catalog, since):
+        self.catalog = catalog
+        self.since = since
+
+    # ------------ Object metadata -------------------------------------------------------------------------------------
+
+    @property
+    def last_modified_utc(self):
+        return self.catalog.last_modified_utc
+
+    @property
+    def last_modified_http(self):
+        return self.catalog.last_modified_http
+
+    def __repr__(self):
+        return "<%s:%s since %s>" % (self.__class__.__name__, self.catalog.id_, string_from_utc(self.since))
+
+    # ------------ Writing content -------------------------------------------------------------------------------------
+
+    def serialization_of_type(self, data_type, encoding=None):
+        if data_type == DataType.json:
+            return encoded_content(json.dumps(self.entries()), encoding)
+
+    def etag_of_type(self, data_type, encoding=None):
+        return None
+
+    def entries(self):
+        since = self.since.replace(tzinfo=None)
+        array = []
+        modified = {}
+        query = self.catalog.cataloged_class.query(Resource.last_modified >= since).order(-Resource.last_modified)
+        for entry in query:
+            array.append(Catalog.entry_for_resource(entry))
+            modified[entry.id_] = entry.last_modified
+        for tombstone in Tombstone.query(Tombstone.deleted >= since, ancestor=self.catalog.key):
+            identifier = tombstone.key.id()
+            if identifier in modified and modified[identifier] >= tombstone.deleted:
+                continue  # the resource was created again after its deletion
+            array.append({'id': identifier, 'lm': string_from_utc(tombstone.deleted_utc), 'del': True})
+        return array
+
+
+class ResourceBatch(object):
+    """
+    ResourceBatch publishes a selection of resources of one class as a single document:
+    {"items": [serializations of the resources], "missing": [identifiers that could not be provided]}
+    The serializations of the items are taken from the resource cache.
+    """
+
+    def __init__(self, resources, missing=None):
+        self.resources = resources
+        self.missing = missing or []
+
+    # ------------ Object metadata -------------------------------------------------------------------------------------
+
+    @property
+    def last_modified_utc(self):
+        if not self.resources:
+            return now_utc().replace(microsecond=0)
+        return max(resource.last_modified_utc for resource in self.resources)
+
+    @property
+    def last_modified_http(self):
+        return rfc1123_from_utc(self.last_modified_utc)
+
+    def __repr__(self):
+        return "<%s: %d items, %d missing>" % (self.__class__.__name__, len(self.resources), len(self.missing))
+
+    # ------------ Writing content -------------------------------------------------------------------------------------
+
+    def serialization_of_type(self, data_type, encoding=None):
+        if data_type == DataType.json:
+            items = ', '.join(resource.serialization_of_type(data_type) for resource in self.resources)
+            document = '{"items": [%s], "missing": %s}' % (items, json.dumps(self.missing))
+            return encoded_content(document, encoding)
+        codec = DataType.codec(data_type)
+        if codec is not None:
+            items = [resource.dictionary_from_object() for resource in self.resources]
+            return encoded_content(codec.encode({'items': items, 'missing': self.missing}), encoding)
+
+    def etag_of_type(self, data_type, encoding=None):
+        """
+        Provides an entity tag derived from the cached entity tags of the items
+        """
+        if DataType.codec(data_type) is not None:
+            tags = [resource.etag_of_type(data_type) for resource in self.resources]
+            tags.append(json.dumps(self.missing))
+            tags.append(DataType.s[data_type])
+            return etag_for_encoding(etag_for_content(' '.join(tags)), encoding)
+
+
+class CatalogShard(ndb.Model):
+    """
+    CatalogShard holds the catalog entries for the resources whose id hashes to its index, as a json fragment.
+    Shards are stored as children of their Catalog, an invalid shard has None as entries.
+    The invalidated property records the moment the entries were last invalidated, not the moment they were rebuilt.
+    """
+    last_modified = ndb.DateTimeProperty(auto_now=True)
+    invalidated = ndb.DateTimeProperty(indexed=False)
+    entries = ndb.TextProperty()
+
+    @staticmethod
+    def index_for_identifier(identifier, shard_count):
+        return int(md5_hash([str(identifier)])[:8], 16) % shard_count
+
+    @classmethod
+    def key_for_index(cls, catalog_key, index):
+        return ndb.Key(cls, index + 1, parent=catalog_key)
+
+    @classmethod
+    def invalidate(cls, cataloged_class, identifier):
+        """
+        Invalidates the shard holding the entry of the specified resource, costs one get and at most one put
+        """
+        index = cls.index_for_identifier(identifier, cataloged_class.catalog_shard_count)
+        shard = cls.key_for_index(ndb.Key(Catalog, cataloged_class.__name__), index).get()
+        if shard is not None and shard.entries is not None:
+            logging.info('== invalidate catalog shard %d ==' % index)
+            shard.invalidate_entries()
+            shard.put()
+
+    @classmethod
+    def invalidate_multi(cls, cataloged_class, identifiers):
+        """
+        Invalidates the shards holding the entries of the specified resources, each shard at most once
+        """
+        catalog_key = ndb.Key(Catalog, cataloged_class.__name__)
+        indexes = set(cls.index_for_identifier(identifier, cataloged_class.catalog_shard_count)
+                      for identifier in identifiers)
+        shards = ndb.get_multi([cls.key_for_index(catalog_key, index) for index in indexes])
+        invalidated = [shard for shard in shards if shard is not None and shard.entries is not None]
+        for shard in invalidated:
+            shard.invalidate_entries()
+        if invalidated:
+            logging.info('== invalidate %d catalog shards ==' % len(invalidated))
+            ndb.put_multi(invalidated)
+
+    def invalidate_entries(self):
+        self.entries = None
+        self.invalidated = now_utc().replace(tzinfo=None)
+
+
+class Tombstone(ndb.Model):
+    """
+    Tombstone records the deletion of a cataloged resource, enabling CatalogDelta to report deletions.
+    Tombstones are stored as children of the Catalog of the deleted resource, with the id of the deleted resource.
+    They are kept for retention: changes are only provided since moments within the retention, earlier moments get
+    the full catalog. Older tombstones can be removed with prune(), e.g. from a cron job.
+    """
+    deleted = ndb.DateTimeProperty(auto_now=True)
+    retention = timedelta(days=30)
+
+    @classmethod
+    def bury(cls, cataloged_class, identifier):
+        cls(parent=ndb.Key(Catalog, cataloged_class.__name__), id=identifier).put()
+
+    @classmethod
+    def retention_start(cls):
+        return now_utc() - cls.retention
+
+    @classmethod
+    def prune(cls, cataloged_class):
+        """
+        Removes the tombstones of cataloged_class that are older than the retention
+        :return: the number of removed tombstones
+        """
+        cutoff = cls.retention_start().replace(tzinfo=None)
+        query = cls.query(cls.deleted < cutoff, ancestor=ndb.Key(Catalog, cataloged_class.__name__))
+        keys = query.fetch(keys_only=True)
+        ndb.delete_multi(keys)
+        return len(keys)
+
+    @property
+    def deleted_utc(self):
+        return mark_utc(self.deleted.replace(microsecond=0))
 
 
 class PublicResource(Resource):
     is_publication = True
     identifier_regex = re.compile('\w{1,19}$')
+    catalog_shard_count = 16
 
     # ------------ Object lifecycle ------------------------------------------------------------------------------------
 
     @classmethod
     def new(cls, identifier=None):
         logging.info('Creating new %s with id: %s' % (cls.__name__, identifier))
-        cls.invalidate_catalog()
         return super(PublicResource, cls).new(identifier=identifier)
 
-    def put(self):
-        super(Resource, self).put()
-        self.__class__.invalidate_catalog()
+    def put(self, **ctx_options):
+        key = super(PublicResource, self).put(**ctx_options)
+        self.__class__.invalidate_catalog(self.id_)
+        return key
+
+    @classmethod
+    def put_multi(cls, instances):
+        super(PublicResource, cls).put_multi(instances)
+        CatalogShard.invalidate_multi(cls, [instance.id_ for instance in instances])
 
     def delete(self):
         super(PublicResource, self).delete()
-        self.__class__.invalidate_catalog()
+        self.__class__.invalidate_catalog(self.id_)
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        """
+        Records the deletion with a Tombstone, for every way of deleting (also ndb.delete_multi and key.delete())
+        """
+        super(PublicResource, cls)._post_delete_hook(key, future)
+        if future.get_exception() is None:
+            Tombstone.bury(cls, key.id())
 
     @classmethod
-    def invalidate_catalog(cls):
-        catalog = Catalog.get(cls)
-        catalog.invalidate()
+    def invalidate_catalog(cls, identifier=None):
+        """
+        Invalidates the catalog shard holding the entry of the specified resource, or the whole catalog if identifier
+        is None (e.g. after saving objects in bulk)
+        """
+        if identifier is None:
+            Catalog.get(cls).invalidate()
+        else:
+            CatalogShard.invalidate(cls, identifier)
 
 
 class User(Resource):
@@ -345,8 +971,7 @@ class User(Resource):
             user_realm = dictionary.get('realm')
             password = dictionary.get('token')
             if password and user_realm == self.realm:
-                self.put()  # Put causes an ndb.key to be created, which is used as username and required for ha1
-                self.password = password
+                self.password = password  # new() assigned the key, which is used as username and required for ha1
             else:
                 raise InvalidUpdateDataError
         else:
@@ -400,6 +1025,85 @@ class UserResource(Resource):
         return int(super(UserResource, cls).valid_identifier(str(identifier)))
 
 
+# ====== Id allocation =============================================================================
+
+
+class IdPool(object):
+    """
+    IdPool hands out numeric ids for a model class, from blocks reserved with allocate_ids().
+    A pool is shared by the threads of an instance, one allocate_ids() call provides ids for block_size new objects.
+    Ids that are not used before the instance shuts down are lost, which is harmless.
+    """
+
+    def __init__(self, model_class, block_size=100):
+        self.model_class = model_class
+        self.block_size = block_size
+        self._next = 0
+        self._last = -1
+        self._lock = threading.Lock()
+
+    def next_id(self):
+        with self._lock:
+            if self._next > self._last:
+                self._next, self._last = self.model_class.allocate_ids(size=self.block_size)
+            identifier = self._next
+            self._next += 1
+            return identifier
+
+
+# ====== Unit of work ==============================================================================
+
+
+class UnitOfWork(object):
+    """
+    UnitOfWork collects the resources changed while handling a request, to store them with the minimal number of
+    datastore writes. While a unit of work is active (within its with statement) Resource.save() registers resources
+    instead of storing them.
+    flush() stores the registered resources with one put_multi() per class, which performs the side effects
+    (catalog invalidation, resetting the ids) once per class. Leaving the with statement without exception flushes.
+    """
+    _local = threading.local()
+
+    def __init__(self):
+        self.dirty = []
+        self.previous = None
+
+    @classmethod
+    def current(cls):
+        return getattr(cls._local, 'unit_of_work', None)
+
+    def __enter__(self):
+        self.previous = UnitOfWork.current()
+        UnitOfWork._local.unit_of_work = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        UnitOfWork._local.unit_of_work = self.previous
+        if exc_type is None:
+            self.flush()
+
+    def register(self, resource):
+        for registered in self.dirty:
+            if registered is resource:
+                return
+        self.dirty.append(resource)
+
+    def flush(self):
+        if not self.dirty:
+            return
+        classes = []
+        resources = {}
+        for resource in self.dirty:
+            resource_class = resource.__class__
+            if resource_class not in resources:
+                classes.append(resource_class)
+                resources[resource_class] = []
+            resources[resource_class].append(resource)
+        self.dirty = []
+        for resource_class in classes:
+            resource_class.put_multi(resources[resource_class])
+
+
 # ====== Exceptions =================================================================================
 
 
@@ -408,4 +1112,8 @@ class NoValidIdentifierError(Exception):
 
 
 class InvalidUpdateDataError(Exception):
+    pass
+
+
+class BatchTooLargeError(Exception):
     pass
\ No newline at end of file
@@ -0,0 +1,119 @@
+# coding=utf-8
+#
+#  Copyright (c) 2014-2015 First Flamingo Enterprise B.V.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#  rest_throttle.py
+#  firstflamingo/python_utilities
+#
+
+import logging
+import threading
+import time
+
+from google.appengine.api import memcache
+from rest_cache import LRUCache
+
+
+# ====== Token buckets =================================================================================================
+
+
+class TokenBucket(object):
+    """
+    TokenBucket admits bursts of capacity requests, refilled with rate requests per second.
+    consumed counts the admitted requests since the last reconciliation with memcache.
+    """
+
+    def __init__(self, capacity, rate, now):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = float(capacity)
+        self.updated = now
+        self.consumed = 0
+        self.reconciled = now
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, now):
+        """
+        Takes a token for a request
+        :return: 0 if the request is admitted, otherwise the number of seconds until a token is available
+        """
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.consumed += 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def drain(self):
+        self.tokens = 0.0
+
+
+class RateLimiter(object):
+    """
+    RateLimiter keeps a TokenBucket per scope and client in-process, so admitting a request costs no RPC.
+    Every reconcile_interval seconds the consumption of a bucket is added to a memcache counter, shared by all
+    instances, for the current window of window seconds. When the combined consumption within the window exceeds
+    what the limit allows, the local bucket is drained, so a client spreading its requests over instances is
+    throttled as well.
+    """
+
+    def __init__(self, reconcile_interval=10, window=60, max_buckets=10000):
+        self.reconcile_interval = reconcile_interval
+        self.window = window
+        self.buckets = LRUCache(max_buckets)
+        self._lock = threading.Lock()
+
+    def check(self, scope, client, limit):
+        """
+        Admits or refuses a request of client within scope
+        :param limit: tuple (capacity, rate in requests per second), None for no limit
+        :return: 0 if the request is admitted, otherwise the number of seconds the client should wait
+        """
+        if limit is None:
+            return 0
+        capacity, rate = limit
+        key = (scope, client)
+        now = time.time()
+        with self._lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(capacity, rate, now)
+                self.buckets.set(key, bucket, 1)
+            wait = bucket.consume(now)
+            reconcile = now - bucket.reconciled >= self.reconcile_interval and bucket.consumed > 0
+            if reconcile:
+                consumed = bucket.consumed
+                bucket.consumed = 0
+                bucket.reconciled = now
+        if reconcile:
+            self.reconcile(bucket, scope, client, consumed, now)
+        if wait:
+            logging.info('Throttled %s in %s for %.1f seconds' % (client, scope, wait))
+        return wait
+
+    def reconcile(self, bucket, scope, client, consumed, now):
+        window_key = 'throttle:%s:%s:%d' % (scope, client, int(now // self.window))
+        memcache.add(window_key, 0, time=2 * self.window)
+        total = memcache.incr(window_key, delta=consumed, initial_value=0)
+        if total is not None and total > bucket.capacity + bucket.rate * self.window:
+            logging.info('Throttled %s in %s on all instances' % (client, scope))
+            with self._lock:
+                bucket.drain()
+
+
+rate_limiter = RateLimiter()